@@ -0,0 +1,5 @@
+# -*- encoding: utf-8 -*-
+"""
+Ferramentas de medição de desempenho. Devem ser executadas a partir da raiz do
+repositório, como módulos (p.ex. `python -m bench.extractbench --help`).
+"""
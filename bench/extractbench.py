@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+"""
+Mede o desempenho do extract sobre CVs sintéticos (vide `bench.lattesgen`),
+sem acessar o web service do CNPq.
+
+Para cada tamanho de CV (número de produções), executa em um processo próprio
+as seguintes etapas, reportando CVs/s, produções/s e o pico de memória (RSS):
+
+- parse: construção dos metadados (`CVParser`/`MetadataProcessor`);
+- insert: pipeline completo do extract, de `yieldCVs` a `processCV`, com um
+  `WSCurriculo` simulado e um banco de dados vazio;
+- reextract: o mesmo pipeline com `--force` sobre os mesmos CVs, que não devem
+  gerar nenhuma revisão nova.
+
+ATENÇÃO: os schemas `core` e `synclattes` do banco de dados indicado em
+--db-url são apagados e recriados. Utilize um banco de dados descartável.
+
+Exemplo:
+    python -m bench.extractbench --db-url postgresql://postgres@localhost/synclattes_bench
+"""
+import sys, imp, json, time, datetime, logging, argparse, resource, multiprocessing
+from bench.lattesgen import LattesGenerator, compress
+
+logger = logging.getLogger('extractbench')
+
+ID_CNPQ_BASE = 1000000000000000
+
+
+class StubWSCurriculo(object):
+    """ Substitui `ws.WSCurriculo`, servindo CVs previamente gerados """
+    def __init__(self, payloads, cpfs):
+        self.payloads = payloads  # id_cnpq => conteúdo compactado
+        self.idsByCpf = dict(zip(cpfs, sorted(payloads)))
+        self.dataAtualizacao = datetime.datetime(2016, 1, 1)
+
+    def obterCVCompactado(self, id_cnpq):
+        return self.payloads.get(id_cnpq)
+
+    def obterIdCNPq(self, cpfOuNome, nascimento=None):
+        return self.idsByCpf.get(cpfOuNome)
+
+    def obterOcorrencia(self, id_cnpq):
+        return None
+
+    def obterDataAtualizacao(self, id_cnpq):
+        return self.dataAtualizacao
+
+
+def resetDatabase(db):
+    """ Recria os schemas e tabelas do banco de dados de testes """
+    db.session.close()
+    db.getEngine().execute('DROP SCHEMA IF EXISTS synclattes CASCADE; '
+                      'DROP SCHEMA IF EXISTS core CASCADE; '
+                      'CREATE SCHEMA synclattes; CREATE SCHEMA core')
+    db.Base.metadata.create_all(db.getEngine())
+
+def createPessoas(db, n):
+    """ Cria `n` pessoas ainda sem PessoaLattes, retornando seus CPFs """
+    cpfs = ['%011d' % i for i in xrange(1, n + 1)]
+    db.session.add_all([db.Pessoa(id=i, cpf=cpf, nome='Pessoa %d' % i,
+                                  data_nascimento=datetime.date(1970, 1, 1),
+                                  idioma='pt', nacionalidade_id=1)
+                        for i, cpf in enumerate(cpfs, 1)])
+    db.session.commit()
+    return cpfs
+
+def peakRSS():
+    """ Pico de memória residente do processo, em MiB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def measure(stage, size, numCVs, numProducoes, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    return {
+        'stage': stage,
+        'size': size,
+        'cvs': numCVs,
+        'producoes': numProducoes,
+        'seconds': elapsed,
+        'cvs_per_s': numCVs / elapsed,
+        'producoes_per_s': numProducoes / elapsed,
+        'peak_rss_mib': peakRSS(),
+    }
+
+def runSize(args, size, results):
+    """ Executa as etapas para CVs de `size` produções (no processo filho) """
+    import db
+    extract = imp.load_source('extract', 'extract')
+    logging.getLogger().setLevel(logging.WARNING)
+    # Descarta as conexões herdadas do processo pai
+    db.getEngine().dispose()
+    resetDatabase(db)
+
+    gen = LattesGenerator(args.seed)
+    ids = [str(ID_CNPQ_BASE + i) for i in xrange(args.cvs)]
+    payloads = {id_cnpq: compress(gen.cv(id_cnpq, size // 2, size - size // 2))
+                for id_cnpq in ids}
+    numProducoes = args.cvs * size
+    cpfs = createPessoas(db, args.cvs)
+    extract._wsCV = StubWSCurriculo(payloads, cpfs)
+    extract.cvCache = None
+
+    def parse():
+        for id_cnpq in ids:
+            extract.parseCVPayload(id_cnpq, payloads[id_cnpq])
+
+    def pipeline(force):
+        def run():
+            pessoas = extract.yieldPessoas(cpfs)
+            cvs = extract.yieldCVs(pessoas, force=force)
+            for pessoaLattes, lastUpdate, producoes in extract.parseCVs(cvs):
+                extract.processCV(pessoaLattes, producoes, lastUpdate)
+        return run
+
+    results.put(measure('parse', size, args.cvs, numProducoes, parse))
+    results.put(measure('insert', size, args.cvs, numProducoes, pipeline(False)))
+    revisions = db.session.query(db.Revision).count()
+    results.put(measure('reextract', size, args.cvs, numProducoes, pipeline(True)))
+    if db.session.query(db.Revision).count() != revisions:
+        logger.error('A reextração de CVs idênticos gerou novas revisões')
+    db.session.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Mede o desempenho do extract sobre CVs sintéticos')
+    parser.add_argument('--db-url', required=True,
+                        help='URL de um banco de dados PostgreSQL descartável')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='números de produções por CV, separados por vírgula')
+    parser.add_argument('--cvs', type=int, default=20,
+                        help='número de CVs gerados para cada tamanho')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='semente do gerador de CVs')
+    parser.add_argument('--json', metavar='ARQUIVO',
+                        help='grava também os resultados em formato JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # Deve ser configurado antes do primeiro acesso ao banco de dados
+    import conf.dbconf as dbconf
+    dbconf.url = args.db_url
+
+    rows = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        # Cada tamanho é medido em um processo novo, para que o pico de
+        # memória de um tamanho não contamine o do seguinte
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=runSize, args=(args, size, results))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            logger.error('Falha ao medir CVs de %d produções', size)
+            sys.exit(1)
+        while not results.empty():
+            rows.append(results.get())
+
+    print('%-10s %6s %5s %10s %9s %8s %12s %10s' % ('etapa', 'prods', 'CVs', 'produções',
+                                                    'tempo (s)', 'CVs/s', 'produções/s', 'RSS (MiB)'))
+    for row in rows:
+        print('%-10s %6d %5d %10d %9.2f %8.1f %12.1f %10.1f' % (
+            row['stage'], row['size'], row['cvs'], row['producoes'], row['seconds'],
+            row['cvs_per_s'], row['producoes_per_s'], row['peak_rss_mib']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+"""
+Gerador de CVs Lattes sintéticos, para medir o desempenho da extração sem
+acessar o web service do CNPq.
+
+Os CVs gerados reproduzem as peculiaridades do XML real que exercitam o
+extract: entities HTML codificadas duas vezes (`&amp;amp;`), tags HTML
+escapadas nos campos, mais de um nome em NOME-PARA-CITACAO, autores com e
+sem NRO-ID-CNPQ, DOIs no formato legado `[doi:...]`, ano inválido (1900),
+produções sem título e seções não suportadas entre as suportadas.
+"""
+import io, random, zipfile
+from xml.sax.saxutils import quoteattr
+
+PRENOMES = [u'José', u'Maria', u'João', u'Ana', u'Antônio', u'Francisca', u'Luís',
+            u'Cecília', u'Conceição', u'Sérgio', u'Mônica', u'André', u'Lúcia']
+SOBRENOMES = [u'Silva', u'Santos', u'Oliveira', u'Souza', u'Pereira', u'Gonçalves',
+              u'Araújo', u'Magalhães', u'Conceição', u'de Assis', u'von Braun', u'Frère']
+PALAVRAS = [u'análise', u'síntese', u'estudo', u'modelagem', u'otimização', u'redes',
+            u'polímeros', u'ensino', u'avaliação', u'sistemas', u'cerâmicas', u'genômica',
+            u'aprendizado', u'simulação', u'propriedades', u'térmicas', u'português']
+PERIODICOS = [u'Revista Brasileira de Física', u'Journal of Materials Science',
+              u'Química Nova', u'Ciência &amp; Educação', u'IEEE Transactions on Software Engineering',
+              u'Polímeros: Ciência e Tecnologia', u'Cadernos de Saúde Pública']
+EVENTOS = [u'Congresso Brasileiro de Engenharia', u'Simpósio Brasileiro de Banco de Dados',
+           u'International Conference on Software Engineering', u'Encontro Nacional de Química']
+IDIOMAS = [u'Português', u'Português', u'Inglês', u'Inglês', u'Espanhol']
+
+
+class LattesGenerator(object):
+    """ Gera CVs sintéticos de forma determinística a partir de `seed` """
+    def __init__(self, seed=0):
+        self.rnd = random.Random(seed)
+
+    def nome(self):
+        return u'%s %s %s' % (self.rnd.choice(PRENOMES),
+                              self.rnd.choice(SOBRENOMES),
+                              self.rnd.choice(SOBRENOMES))
+
+    @staticmethod
+    def nomeCitacao(nome):
+        partes = nome.split()
+        iniciais = u' '.join(p[0] + u'.' for p in partes[:-1])
+        return u'%s, %s' % (partes[-1].upper(), iniciais)
+
+    def titulo(self):
+        palavras = [self.rnd.choice(PALAVRAS) for _ in xrange(self.rnd.randint(4, 14))]
+        titulo = u' '.join(palavras).capitalize()
+        r = self.rnd.random()
+        if r < 0.1:
+            # Entity codificada duas vezes, como no XML real
+            titulo += u' &amp;amp; ' + self.rnd.choice(PALAVRAS)
+        elif r < 0.15:
+            # Tag HTML dentro do campo
+            titulo = u'&lt;i&gt;' + titulo + u'&lt;/i&gt;'
+        elif r < 0.18:
+            titulo += u' &amp;#233;tica'
+        return titulo
+
+    def cv(self, id_cnpq, nArtigos=50, nTrabalhos=50):
+        """ Gera o XML (bytes, ISO-8859-1) de um CV com a quantidade pedida de produções """
+        nome = self.nome()
+        citacoes = [self.nomeCitacao(nome), nome.upper()]
+        coautores = [(self.nome(), self.rnd.choice([u'', u'', unicode(self.rnd.randint(10**15, 10**16))]))
+                     for _ in xrange(max(8, (nArtigos + nTrabalhos) // 10))]
+        out = io.StringIO()
+        out.write(u'<?xml version="1.0" encoding="ISO-8859-1" standalone="no" ?>\n')
+        out.write(u'<CURRICULO-VITAE SISTEMA-ORIGEM-XML="LATTES_OFFLINE" NUMERO-IDENTIFICADOR=%s>' %
+                  quoteattr(id_cnpq))
+        out.write(u'<DADOS-GERAIS NOME-COMPLETO=%s NOME-EM-CITACOES-BIBLIOGRAFICAS=%s '
+                  u'NACIONALIDADE="B" PAIS-DE-NASCIMENTO="Brasil">' %
+                  (quoteattr(nome), quoteattr(u';'.join(citacoes))))
+        out.write(u'<RESUMO-CV TEXTO-RESUMO-CV-RH=%s/>' %
+                  quoteattr(u' '.join(self.titulo() for _ in xrange(20))))
+        out.write(u'<FORMACAO-ACADEMICA-TITULACAO>%s</FORMACAO-ACADEMICA-TITULACAO>' %
+                  u''.join(u'<GRADUACAO SEQUENCIA-FORMACAO="%d" NOME-CURSO=%s/>' %
+                           (i, quoteattr(self.titulo())) for i in xrange(3)))
+        out.write(u'</DADOS-GERAIS>')
+        seq = iter(xrange(1, 10**6))
+        out.write(u'<PRODUCAO-BIBLIOGRAFICA><ARTIGOS-PUBLICADOS>')
+        for _ in xrange(nArtigos):
+            out.write(self.producao(u'ARTIGO-PUBLICADO', u'ARTIGO', next(seq), id_cnpq,
+                                    nome, citacoes, coautores))
+        out.write(u'</ARTIGOS-PUBLICADOS><TRABALHOS-EM-EVENTOS>')
+        for _ in xrange(nTrabalhos):
+            out.write(self.producao(u'TRABALHO-EM-EVENTOS', u'TRABALHO', next(seq), id_cnpq,
+                                    nome, citacoes, coautores))
+        out.write(u'</TRABALHOS-EM-EVENTOS>')
+        # Seção não suportada, que deve ser ignorada pelo extract
+        out.write(u'<LIVROS-E-CAPITULOS>%s</LIVROS-E-CAPITULOS>' %
+                  u''.join(u'<LIVRO-PUBLICADO-OU-ORGANIZADO SEQUENCIA-PRODUCAO="%d">'
+                           u'<DADOS-BASICOS-DO-LIVRO TITULO-DO-LIVRO=%s/>'
+                           u'</LIVRO-PUBLICADO-OU-ORGANIZADO>' % (next(seq), quoteattr(self.titulo()))
+                           for _ in xrange((nArtigos + nTrabalhos) // 10)))
+        out.write(u'</PRODUCAO-BIBLIOGRAFICA></CURRICULO-VITAE>')
+        return out.getvalue().encode('iso-8859-1', 'xmlcharrefreplace')
+
+    def producao(self, tag, sufixo, seqProd, id_cnpq, nome, citacoes, coautores):
+        rnd = self.rnd
+        ano = unicode(rnd.choice([rnd.randint(1980, 2016)] * 30 + [1900]))
+        doi = u''
+        homePage = u''
+        r = rnd.random()
+        if r < 0.4:
+            doi = u'10.%d/%s.%d' % (rnd.randint(1000, 9999), sufixo.lower(), seqProd)
+        elif r < 0.45:
+            homePage = u'[doi:10.%d/legado.%d]' % (rnd.randint(1000, 9999), seqProd)
+        elif r < 0.6:
+            homePage = u'[http://www.exemplo.br/%d]' % seqProd
+        titulo = self.titulo() if rnd.random() > 0.005 else u''
+        basicos = {
+            u'NATUREZA': u'COMPLETO',
+            u'TITULO-DO-%s' % sufixo: titulo,
+            u'TITULO-DO-%s-INGLES' % sufixo: self.titulo() if rnd.random() < 0.3 else u'',
+            u'ANO-DO-%s' % sufixo: ano,
+            u'IDIOMA': rnd.choice(IDIOMAS),
+            u'HOME-PAGE-DO-TRABALHO': homePage,
+            u'FLAG-RELEVANCIA': rnd.choice([u'SIM', u'NAO', u'NAO', u'NAO']),
+            u'DOI': doi,
+        }
+        if sufixo == u'ARTIGO':
+            detalhamento = {
+                u'TITULO-DO-PERIODICO-OU-REVISTA': rnd.choice(PERIODICOS),
+                u'ISSN': u'%08d' % rnd.randint(0, 10**8 - 1),
+            }
+        else:
+            evento = rnd.choice(EVENTOS)
+            detalhamento = {
+                u'NOME-DO-EVENTO': evento,
+                u'TITULO-DOS-ANAIS-OU-PROCEEDINGS': rnd.choice([u'Anais', u'Proceedings',
+                                                               u'Anais do ' + evento]),
+                u'ISBN': u'%013d' % rnd.randint(0, 10**13 - 1),
+                u'CIDADE-DA-EDITORA': rnd.choice([u'', u'São Carlos', u'Porto Alegre']),
+                u'NOME-DA-EDITORA': rnd.choice([u'', u'SBC', u'Sociedade Brasileira de Química']),
+            }
+        pagInicial = rnd.randint(1, 900)
+        detalhamento.update({
+            u'VOLUME': unicode(rnd.randint(1, 80)),
+            u'FASCICULO': rnd.choice([u'', unicode(rnd.randint(1, 12))]),
+            u'PAGINA-INICIAL': unicode(pagInicial),
+            u'PAGINA-FINAL': unicode(pagInicial + rnd.randint(0, 20)),
+        })
+        # Autores: o proprietário do CV (nem sempre identificado pelo NRO-ID-CNPQ,
+        # às vezes com mais de um nome para citação) e coautores
+        autores = [(nome, u';'.join(citacoes) if rnd.random() < 0.2 else rnd.choice(citacoes),
+                    id_cnpq if rnd.random() < 0.5 else u'')]
+        for coautor, coautorId in rnd.sample(coautores, rnd.randint(0, min(7, len(coautores)))):
+            autores.append((coautor, self.nomeCitacao(coautor), coautorId))
+        rnd.shuffle(autores)
+        xmlAutores = u''.join(
+            u'<AUTORES NOME-COMPLETO-DO-AUTOR=%s NOME-PARA-CITACAO=%s ORDEM-DE-AUTORIA="%d" '
+            u'NRO-ID-CNPQ=%s/>' % (quoteattr(n), quoteattr(c), i + 1, quoteattr(idAutor))
+            for i, (n, c, idAutor) in enumerate(autores))
+        palavrasChave = u'<PALAVRAS-CHAVE %s/>' % u' '.join(
+            u'PALAVRA-CHAVE-%d=%s' % (i + 1, quoteattr(rnd.choice(PALAVRAS) if i < 3 else u''))
+            for i in xrange(6))
+        areas = u'<AREAS-DO-CONHECIMENTO><AREA-DO-CONHECIMENTO-1 ' \
+                u'NOME-GRANDE-AREA-DO-CONHECIMENTO="CIENCIAS_EXATAS_E_DA_TERRA" ' \
+                u'NOME-DA-AREA-DO-CONHECIMENTO="Química" NOME-DA-SUB-AREA-DO-CONHECIMENTO="" ' \
+                u'NOME-DA-ESPECIALIDADE=""/></AREAS-DO-CONHECIMENTO>'
+        setores = u'<SETORES-DE-ATIVIDADE SETOR-DE-ATIVIDADE-1="Educação" ' \
+                  u'SETOR-DE-ATIVIDADE-2="" SETOR-DE-ATIVIDADE-3=""/>'
+        return u'<%s SEQUENCIA-PRODUCAO="%d"><DADOS-BASICOS-DO-%s %s/><DETALHAMENTO-DO-%s %s/>' \
+               u'%s%s%s%s</%s>' % (
+                   tag, seqProd, sufixo, attrs(basicos), sufixo, attrs(detalhamento),
+                   xmlAutores, palavrasChave, areas, setores, tag)
+
+
+def attrs(d):
+    return u' '.join(u'%s=%s' % (k, quoteattr(v)) for k, v in sorted(d.iteritems()))
+
+def compress(xml):
+    """ Compacta o XML no mesmo formato retornado por getCurriculoCompactado """
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('curriculo.xml', xml)
+    return buf.getvalue()
@@ -0,0 +1,289 @@
+# -*- encoding: utf-8 -*-
+"""
+Detecta regressões nos planos de execução das consultas mais pesadas do
+synclattes, executando-as com EXPLAIN (ANALYZE, BUFFERS) sobre um corpus
+sintético de pessoas, itens, revisões e grupos de duplicatas.
+
+Para cada consulta, o formato do plano (tipos de nó e índices utilizados), o
+tempo de execução e o número de blocos lidos são comparados aos de uma
+execução anterior gravada com --update-baseline. O script termina com status
+diferente de zero caso algum plano mude de formato, ou caso o tempo ou os
+blocos lidos excedam os de referência pelo fator --threshold.
+
+ATENÇÃO: a menos que seja utilizada a opção --skip-load, os schemas `core` e
+`synclattes` do banco de dados indicado em --db-url são apagados e recriados.
+Utilize um banco de dados descartável.
+
+Exemplo:
+    python -m bench.queryplans --db-url postgresql://postgres@localhost/synclattes_bench \\
+                               --update-baseline
+    python -m bench.queryplans --db-url postgresql://postgres@localhost/synclattes_bench
+"""
+import os, sys, imp, json, logging, argparse
+from collections import OrderedDict
+from bench.extractbench import resetDatabase, ID_CNPQ_BASE
+
+logger = logging.getLogger('queryplans')
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'queryplans.baseline.json')
+
+# Parâmetros do corpus que influenciam os planos (gravados junto à referência)
+CORPUS_PARAMS = ('pessoas', 'items', 'revisions', 'dup_fraction', 'group_size', 'seed')
+
+
+def loadCorpus(db, args):
+    """
+    Gera o corpus sintético diretamente no banco de dados:
+    - `pessoas` pessoas, cada uma com um CV Lattes;
+    - `items` itens distribuídos entre os CVs, com 1 a 2*`revisions`-1 revisões
+      cada (de origem extract ou authoritymix), um terço deles com DOI;
+    - grupos de duplicatas de `group_size` itens entre os primeiros
+      `dup_fraction` * `items` itens, que compartilham título e DOI;
+    - metade dos itens já sincronizados com o DSpace.
+    """
+    resetDatabase(db)
+    dupItems = int(args.items * args.dup_fraction)
+    params = {'pessoas': args.pessoas, 'items': args.items, 'revisions': args.revisions,
+              'dupItems': dupItems, 'groupSize': args.group_size, 'idBase': ID_CNPQ_BASE,
+              'seed': (args.seed % 1000) / 1000.}
+    statements = [
+        "SELECT setseed(%(seed)s)",
+        """INSERT INTO core.pessoa (id, version, cpf, data_nascimento, idioma, nacionalidade_id,
+                                    nome, alterado_manualmente)
+           SELECT i, 0, lpad(i::text, 11, '0'), date '1970-01-01', 'pt', 1, 'Pessoa ' || i, false
+             FROM generate_series(1, %(pessoas)s) i""",
+        """INSERT INTO synclattes.pessoa_lattes (id_cnpq, pessoa_id)
+           SELECT (%(idBase)s + i)::text, i FROM generate_series(1, %(pessoas)s) i""",
+        """INSERT INTO synclattes.item (id, id_cnpq, seq_prod, dspace_item_active, nofetch, nosync)
+           SELECT i, (%(idBase)s + 1 + i %% %(pessoas)s)::text, i / %(pessoas)s, false, false, false
+             FROM generate_series(1, %(items)s) i""",
+        "SELECT setval(pg_get_serial_sequence('synclattes.item', 'id'), %(items)s)",
+        # Itens de um mesmo grupo de duplicatas compartilham o "número" da produção
+        """INSERT INTO synclattes.revision (item_id, retrieval_time, source, meta, meta_digest)
+           SELECT item_id, retrieval_time, source, meta, md5(meta::text) FROM (
+               SELECT i.id AS item_id,
+                      timestamp '2015-01-01' + r * interval '30 days' AS retrieval_time,
+                      CASE WHEN r = 1 OR random() < 0.5 THEN 'extract' ELSE 'authoritymix' END AS source,
+                      jsonb_strip_nulls(jsonb_build_object('dc', jsonb_build_object(
+                          'title', jsonb_build_object('', jsonb_build_array(jsonb_build_object(
+                              'value', 'Produção sintética número ' || p.n))),
+                          'type', jsonb_build_object('', jsonb_build_array(jsonb_build_object(
+                              'value', CASE WHEN p.n %% 2 = 0 THEN 'Article' ELSE 'Conference Paper' END))),
+                          'date', jsonb_build_object('issued', jsonb_build_array(jsonb_build_object(
+                              'value', (1990 + p.n %% 30)::text))),
+                          'identifier', CASE WHEN p.n %% 3 = 0 THEN jsonb_build_object('uri', jsonb_build_array(
+                              jsonb_build_object('value', 'http://dx.doi.org/10.1000/' || p.n))) END,
+                          'contributor', jsonb_build_object('author', jsonb_build_array(
+                              jsonb_build_object('value', 'Autor ' || i.id_cnpq),
+                              jsonb_build_object('value', 'Coautor ' || r)))))) AS meta
+                 FROM synclattes.item i,
+                      LATERAL (SELECT CASE WHEN i.id <= %(dupItems)s
+                                           THEN (i.id - 1) / %(groupSize)s
+                                           ELSE i.id END AS n) p,
+                      generate_series(1, 1 + i.id %% (2 * %(revisions)s - 1)) r
+                ORDER BY i.id, r) s""",
+        """UPDATE synclattes.revision r SET duplicate_of_id = m.id
+             FROM synclattes.last_revision lr, synclattes.last_revision m
+            WHERE r.id = lr.id AND lr.item_id <= %(dupItems)s
+              AND (lr.item_id - 1) %% %(groupSize)s <> 0
+              AND m.item_id = lr.item_id - (lr.item_id - 1) %% %(groupSize)s""",
+        """UPDATE synclattes.item i
+              SET dspace_item_id = i.id, dspace_item_active = true, dspace_cur_rev_id = lr.id
+             FROM synclattes.last_revision lr
+            WHERE lr.item_id = i.id AND i.id %% 2 = 0""",
+    ]
+    conn = db.getEngine().connect()
+    try:
+        with conn.begin():
+            for statement in statements:
+                conn.execute(statement, params)
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute('VACUUM ANALYZE')
+    finally:
+        conn.close()
+    logger.info('Corpus carregado: %d revisões, %d últimas revisões, %d duplicatas',
+                db.session.query(db.Revision).count(),
+                db.session.query(db.LastRevision).count(),
+                db.session.query(db.LastRevision).filter(db.LastRevision.duplicate_of_id.isnot(None)).count())
+
+
+def buildQueries(db):
+    """ Consultas avaliadas, obtidas das mesmas funções utilizadas pelos scripts """
+    import dbutil
+    from sqlalchemy import text
+    extract = imp.load_source('extract', 'extract')
+    deduplicate = imp.load_source('deduplicate', 'deduplicate')
+
+    sampleIdCnpq = db.session.query(db.PessoaLattes.id_cnpq).order_by(db.PessoaLattes.id_cnpq).first()[0]
+    sampleDoi = db.session.query(db.LastRevision.doi).filter(db.LastRevision.doi.isnot(None))\
+                          .order_by(db.LastRevision.id).first()[0]
+    sampleItemId = db.session.query(db.func.max(db.Item.id)).scalar() // 2
+
+    def dedupBatch(metaExpr, batch_size):
+        # Primeiro lote percorrido por deduplicate.yieldItemIdMeta (vide db.yield_batches)
+        return dbutil.filterNotYetSynced(deduplicate.itemIdMetaQuery(metaExpr))\
+                     .filter(db.LastRevision.item_id > 0)\
+                     .order_by(db.LastRevision.item_id.asc())\
+                     .limit(batch_size)
+
+    return OrderedDict([
+        ('dbutil.revIdGroups', dbutil.revIdGroupsQuery()),
+        ('dbutil.revIdGroups(sync)', dbutil.revIdGroupsQuery(excludeDeletedMeta=False,
+                                                             excludeSingleRevs=False)),
+        ('deduplicate.itemIdMeta(doi)', dedupBatch(db.LastRevision.doi, 16384)),
+        ('deduplicate.itemIdMeta(title)', dedupBatch(db.LastRevision.title_norm, 128)),
+        ('deduplicate.doiLookup', deduplicate.lastRevisionsQuery()
+                                             .filter(db.LastRevision.doi == sampleDoi)),
+        ('extract.lastItemRevisions', extract.lastItemRevisionsQuery(sampleIdCnpq)),
+        ('last_revision.populate', text(db.lastRevisionPopulateSelect)),
+        # Consulta executada pelo gatilho de last_revision a cada alteração da última revisão
+        ('last_revision.triggerLookup', text('SELECT * FROM synclattes.revision WHERE item_id = :item_id '
+                                             'ORDER BY id DESC LIMIT 1').bindparams(item_id=sampleItemId)),
+    ])
+
+
+def explain(conn, query, repeat):
+    """
+    Executa a consulta `repeat` vezes com EXPLAIN (ANALYZE, BUFFERS), retornando
+    o formato do plano e os menores tempo de execução e número de blocos lidos
+    """
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=conn.dialect)
+    best = None
+    for _ in xrange(repeat):
+        trans = conn.begin()
+        try:
+            result = conn.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + unicode(compiled),
+                                  compiled.params).scalar()
+        finally:
+            trans.rollback()
+        if isinstance(result, basestring):
+            result = json.loads(result)
+        plan = result[0]
+        cur = {'shape': planShape(plan['Plan']),
+               'time_ms': plan['Execution Time'],
+               'buffers': plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0)}
+        if best is None:
+            best = cur
+        else:
+            best['time_ms'] = min(best['time_ms'], cur['time_ms'])
+            best['buffers'] = min(best['buffers'], cur['buffers'])
+    return best
+
+
+def planShape(node):
+    """ Representação textual dos tipos de nó do plano e das tabelas e índices acessados """
+    label = node['Node Type']
+    target = node.get('Index Name') or node.get('Relation Name')
+    if target:
+        label += ' on ' + target
+    children = node.get('Plans', [])
+    if children:
+        label += ' (' + ', '.join(planShape(child) for child in children) + ')'
+    return label
+
+
+def compare(name, cur, ref, args):
+    """ Retorna a lista de regressões da consulta `name` em relação à referência `ref` """
+    problems = []
+    if cur['shape'] != ref['shape']:
+        problems.append('plano alterado:\n    antes:  %s\n    depois: %s' % (ref['shape'], cur['shape']))
+    if cur['time_ms'] > ref['time_ms'] * args.threshold and \
+       cur['time_ms'] - ref['time_ms'] > args.min_time_ms:
+        problems.append('tempo %.2fms > %.1f x %.2fms' % (cur['time_ms'], args.threshold, ref['time_ms']))
+    if cur['buffers'] > ref['buffers'] * args.threshold and \
+       cur['buffers'] - ref['buffers'] > args.min_buffers:
+        problems.append('blocos lidos %d > %.1f x %d' % (cur['buffers'], args.threshold, ref['buffers']))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Detecta regressões nos planos de execução das consultas sobre um corpus sintético')
+    parser.add_argument('--db-url', required=True,
+                        help='URL de um banco de dados PostgreSQL descartável')
+    parser.add_argument('--pessoas', type=int, default=500,
+                        help='número de pessoas (CVs) do corpus')
+    parser.add_argument('--items', type=int, default=50000,
+                        help='número de itens do corpus')
+    parser.add_argument('--revisions', type=int, default=3,
+                        help='número médio de revisões por item')
+    parser.add_argument('--dup-fraction', type=float, default=0.3,
+                        help='fração dos itens que pertencem a grupos de duplicatas')
+    parser.add_argument('--group-size', type=int, default=3,
+                        help='número de itens por grupo de duplicatas')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='semente do gerador do corpus')
+    parser.add_argument('--skip-load', action='store_true',
+                        help='reutiliza o corpus já carregado no banco de dados')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='número de execuções de cada consulta (considera-se a mais rápida)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='arquivo JSON com os planos de referência')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='grava os planos obtidos como nova referência, em vez de compará-los')
+    parser.add_argument('--threshold', type=float, default=2.0,
+                        help='fator de tolerância do tempo e dos blocos lidos em relação à referência')
+    parser.add_argument('--min-time-ms', type=float, default=5.0,
+                        help='diferença de tempo abaixo da qual não se considera regressão')
+    parser.add_argument('--min-buffers', type=int, default=100,
+                        help='diferença de blocos lidos abaixo da qual não se considera regressão')
+    parser.add_argument('--json', metavar='ARQUIVO',
+                        help='grava também os resultados em formato JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # Deve ser configurado antes do primeiro acesso ao banco de dados
+    import conf.dbconf as dbconf
+    dbconf.url = args.db_url
+    import db
+
+    corpus = {param: getattr(args, param) for param in CORPUS_PARAMS}
+    if not args.skip_load:
+        loadCorpus(db, args)
+
+    results = OrderedDict()
+    conn = db.getEngine().connect()
+    try:
+        for name, query in buildQueries(db).iteritems():
+            results[name] = explain(conn, query, args.repeat)
+    finally:
+        conn.close()
+        db.session.close()
+
+    print('%-32s %10s %10s  %s' % ('consulta', 'tempo (ms)', 'blocos', 'plano'))
+    for name, res in results.iteritems():
+        print('%-32s %10.2f %10d  %s' % (name, res['time_ms'], res['buffers'], res['shape']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'corpus': corpus, 'queries': results}, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'corpus': corpus, 'queries': results}, f, indent=2)
+        logger.info('Referência gravada em %r', args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        logger.error('Referência %r inexistente; execute com --update-baseline', args.baseline)
+        sys.exit(2)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['corpus'] != corpus:
+        logger.error('Corpus diferente do utilizado na referência: %r vs %r', corpus, baseline['corpus'])
+        sys.exit(2)
+
+    failed = False
+    for name, res in results.iteritems():
+        ref = baseline['queries'].get(name)
+        if ref is None:
+            logger.warning('%s: consulta ausente da referência', name)
+            continue
+        for problem in compare(name, res, ref, args):
+            logger.error('%s: %s', name, problem)
+            failed = True
+    if failed:
+        sys.exit(1)
+    logger.info('Nenhuma regressão encontrada em %d consultas', len(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# -*- encoding: utf-8 -*-
+import io, json, datetime, logging
+from collections import OrderedDict
+import db, metadata
+
+logger = logging.getLogger('bulkload')
+
+
+class BulkWriter(object):
+    """
+    Grava itens e revisões em lote, via COPY ... FROM STDIN, em vez de um INSERT
+    por objeto. Destina-se a cargas iniciais (modo --backfill dos scripts), nas
+    quais milhares de revisões são inseridas de uma só vez.
+
+    Os IDs dos novos registros são reservados antecipadamente nas sequências do
+    banco de dados, de forma que possam ser referenciados antes da gravação.
+    Os dados são enviados na conexão da sessão `session`, dentro da transação
+    corrente, cabendo ao chamador efetivá-la (vide `commitIfFull`).
+
+    As datas de atualização dos CVs (vide `setCVLastUpdate`) também aguardam o
+    lote, para que nunca sejam efetivadas antes dos itens e revisões do CV.
+    Os registros de cada CV são delimitados por `beginCV`, que permite descartá-los
+    (vide `rollbackCV`) caso o processamento do CV falhe.
+    """
+    def __init__(self, session, batch_size=8192):
+        self.session = session
+        self.batch_size = batch_size
+        self.items = []
+        self.revisions = []
+        self.duplicateOf = []    # tuplas (rev_id, duplicate_of_id), a última prevalece
+        self.cvLastUpdates = []  # tuplas (pessoaLattes, data de atualização do CV)
+        self.cvs = set()         # id_cnpq dos CVs com registros no lote
+        self.reservedIds = {db.Item: [], db.Revision: []}
+
+    def addItem(self, id_cnpq, seq_prod):
+        """ Adiciona um novo item ao lote, retornando o seu ID """
+        item_id = self._nextId(db.Item)
+        self.items.append((item_id, id_cnpq, seq_prod, False, False, False))
+        return item_id
+
+    def addRevision(self, item_id, source, meta, duplicate_of_id=None, meta_digest=None):
+        """
+        Adiciona uma nova revisão ao lote, retornando o seu ID. O `meta_digest` é
+        calculado a partir de `meta` caso não seja fornecido.
+        """
+        rev_id = self._nextId(db.Revision)
+        if meta_digest is None:
+            meta_digest = metadata.digest(meta)
+        self.revisions.append((rev_id, item_id, datetime.datetime.utcnow(), source,
+                               meta, duplicate_of_id, meta_digest))
+        return rev_id
+
+    def setDuplicateOf(self, rev_ids, duplicate_of_id):
+        """
+        Altera o duplicate_of_id de revisões já existentes. A alteração é aplicada
+        após a gravação do lote, pois `duplicate_of_id` pode referenciar uma das
+        revisões novas.
+        """
+        self.duplicateOf.extend((rev_id, duplicate_of_id) for rev_id in rev_ids)
+
+    def setCVLastUpdate(self, pessoaLattes, lastUpdate):
+        """ Registra a data de atualização do CV de `pessoaLattes` ao gravar o lote """
+        self.cvLastUpdates.append((pessoaLattes, lastUpdate))
+
+    def beginCV(self, id_cnpq):
+        """
+        Inicia os registros do CV `id_cnpq`, retornando uma marca para `rollbackCV`.
+
+        Caso o CV já possua registros no lote (pessoa repetida na entrada), o lote
+        é gravado antes, pois os itens pendentes não são visíveis em consultas ao
+        banco de dados e seriam inseridos novamente.
+        """
+        if id_cnpq in self.cvs:
+            self.commit()
+        self.cvs.add(id_cnpq)
+        return (id_cnpq, len(self.items), len(self.revisions), len(self.duplicateOf),
+                len(self.cvLastUpdates))
+
+    def rollbackCV(self, mark):
+        """ Descarta os registros adicionados ao lote desde a chamada a `beginCV` """
+        id_cnpq, numItems, numRevisions, numDuplicateOf, numCVLastUpdates = mark
+        del self.items[numItems:]
+        del self.revisions[numRevisions:]
+        del self.duplicateOf[numDuplicateOf:]
+        del self.cvLastUpdates[numCVLastUpdates:]
+        self.cvs.discard(id_cnpq)
+
+    def pending(self):
+        return len(self.items) + len(self.revisions) + len(self.duplicateOf) + len(self.cvLastUpdates)
+
+    def commitIfFull(self):
+        """ Grava o lote e efetiva a transação caso o lote esteja completo """
+        if self.pending() >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        """ Grava o lote e efetiva a transação """
+        self.flush()
+        self.session.commit()
+
+    def flush(self):
+        """ Grava todos os registros pendentes """
+        if self.pending() == 0:
+            return
+        cursor = self.session.connection().connection.cursor()
+        try:
+            copyRows(cursor, db.Item.__table__,
+                     ['id', 'id_cnpq', 'seq_prod', 'dspace_item_active', 'nofetch', 'nosync'],
+                     self.items)
+            copyRows(cursor, db.Revision.__table__,
+                     ['id', 'item_id', 'retrieval_time', 'source', 'meta', 'duplicate_of_id',
+                      'meta_digest'],
+                     self.revisions)
+            duplicateOf = OrderedDict(self.duplicateOf)
+            if len(duplicateOf) > 0:
+                cursor.execute('UPDATE synclattes.revision AS r SET duplicate_of_id = v.duplicate_of_id '
+                               'FROM (VALUES ' + ','.join(['(%s, %s)'] * len(duplicateOf)) + ') '
+                               'AS v(id, duplicate_of_id) WHERE r.id = v.id',
+                               [x for pair in duplicateOf.iteritems() for x in pair])
+        finally:
+            cursor.close()
+        for pessoaLattes, lastUpdate in self.cvLastUpdates:
+            pessoaLattes.cv_last_update = lastUpdate
+        self.session.flush()
+        logger.info('Gravados em lote %d itens, %d revisões e %d marcações de duplicata',
+                    len(self.items), len(self.revisions), len(self.duplicateOf))
+        self.items = []
+        self.revisions = []
+        self.duplicateOf = []
+        self.cvLastUpdates = []
+        self.cvs = set()
+
+    def _nextId(self, model):
+        """ Obtém um ID da sequência de `model`, reservando-os em blocos de `batch_size` """
+        reserved = self.reservedIds[model]
+        if len(reserved) == 0:
+            table = model.__table__
+            reserved.extend(reversed([row[0] for row in self.session.execute(
+                'SELECT nextval(pg_get_serial_sequence(:table, :column)) '
+                'FROM generate_series(1, :n)',
+                {'table': '%s.%s' % (table.schema, table.name),
+                 'column': 'id',
+                 'n': self.batch_size})]))
+        return reserved.pop()
+
+
+def copyRows(cursor, table, columns, rows):
+    """ Envia `rows` para as colunas `columns` de `table` com o comando COPY """
+    if len(rows) == 0:
+        return
+    buf = io.BytesIO()
+    for row in rows:
+        buf.write('\t'.join(copyValue(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert('COPY %s.%s (%s) FROM STDIN' % (table.schema, table.name, ', '.join(columns)),
+                       buf)
+
+def copyValue(value):
+    """ Codifica `value` no formato texto do COPY """
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\')\
+                     .replace('\t', '\\t')\
+                     .replace('\n', '\\n')\
+                     .replace('\r', '\\r')
@@ -0,0 +1,19 @@
+# -*- encoding: utf-8 -*-
+
+# Configurações do compactrevisions, que passa a armazenar as revisões
+# substituídas por outras mais recentes apenas como diferenças (vide jsondelta)
+
+# Idade mínima (em dias) das revisões a serem compactadas
+minAgeDays = 90
+
+# A cada `snapshotInterval` revisões de um mesmo item e origem, uma é mantida
+# completa, limitando o número de patches aplicados na reconstrução do meta
+snapshotInterval = 10
+
+# Revisões substituídas mais antigas que `retentionDays` dias são removidas,
+# exceto as referenciadas por item.dspace_cur_rev_id ou por duplicate_of_id.
+# None mantém todo o histórico
+retentionDays = None
+
+# Número de itens processados por transação
+itemsPerCommit = 256
@@ -1,4 +1,69 @@
 # -*- encoding: utf-8 -*-
 
 WSCurriculoUrl = 'https://cnpqwsproxy.ufscar.br:7443/srvcurriculo/WSCurriculo?wsdl'
-serverEncoding = 'iso-8859-1'
\ No newline at end of file
+serverEncoding = 'iso-8859-1'
+
+# Por quantos dias uma pessoa para a qual não foi encontrado um CV Lattes deixa
+# de ser buscada novamente no web service (modo `extract`)
+noCVLookupTTLDays = 30
+
+# Cliente do web service: 'suds' (interpreta o WSDL, uma instância por thread)
+# ou 'raw' (envelopes SOAP montados diretamente, uma instância compartilhada
+# entre as threads, com conexões HTTP persistentes)
+wsClient = 'suds'
+
+# Diretório onde o WSDL é armazenado pelo cliente 'suds', e por quantos dias o
+# arquivo armazenado é reutilizado. Caso None, é utilizado o diretório
+# temporário padrão do suds.
+wsdlCacheDir = None
+wsdlCacheDays = 30
+
+# Políticas de novas tentativas das chamadas ao web service, por operação
+# (vide wspolicy.Policy). A espera antes de cada nova tentativa é sorteada entre
+# 0 e min(maxDelay, baseDelay * 2**(tentativa-1)) segundos. A política 'default'
+# se aplica às operações não listadas.
+wsPolicies = {
+    'default': {'retries': 3, 'baseDelay': 1.0, 'maxDelay': 30.0},
+    'getCurriculoCompactado': {'retries': 4, 'baseDelay': 2.0, 'maxDelay': 60.0},
+    'getOcorrenciaCV': {'retries': 1, 'baseDelay': 1.0, 'maxDelay': 5.0},
+}
+
+# Limite de requisições por segundo ao web service, somando todas as threads
+# (None para ilimitado), e tamanho máximo de uma rajada de requisições
+wsRateLimit = 20.0
+wsRateBurst = 20
+
+# Após `wsBreakerThreshold` falhas consecutivas (apenas erros de conexão, timeouts
+# e erros de gateway, vide ws.isUnavailabilityError), o web service é considerado
+# indisponível e todas as chamadas são suspensas por `wsBreakerResetTime`
+# segundos, após os quais uma única chamada de teste é liberada
+wsBreakerThreshold = 10
+wsBreakerResetTime = 60.0
+
+# Namespace das operações do web service (utilizado pelo cliente 'raw')
+wsNamespace = 'http://ws.servico.repositorio.cnpq.br/'
+
+# Número máximo de conexões HTTP (e portanto de requisições simultâneas) do
+# cliente 'raw'. Para aproveitá-las, aumente também `downloadWorkers`.
+wsMaxConnections = 64
+
+# Tempo limite de cada requisição do cliente 'raw', em segundos
+wsTimeout = 120.0
+
+# Número de clientes do web service utilizados para baixar CVs em paralelo
+# (modo `extract --parallel`)
+downloadWorkers = 8
+
+# Número máximo de CVs já baixados aguardando para serem gravados no banco de
+# dados (modo `extract --parallel`)
+downloadQueueSize = 32
+
+# Diretório onde é armazenado o conteúdo bruto dos CVs baixados, permitindo
+# reprocessá-los sem acesso à rede (modo `extract --from-cache`).
+# Caso None, os CVs não são armazenados.
+cvCacheDir = None
+
+# Espaço máximo ocupado pelo armazenamento de CVs. Ao final de cada execução do
+# `extract`, as versões mais antigas são removidas até que esse limite seja
+# respeitado (a versão mais recente de cada CV é sempre mantida).
+cvCacheMaxBytes = 8 * 1024**3
@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+import os, errno, hashlib, datetime, tempfile, threading, logging
+import conf.wsconf as wsconf
+
+logger = logging.getLogger('cvcache')
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CVCache(object):
+    """
+    Armazena em disco o conteúdo compactado (zip) dos CVs obtidos do web service,
+    permitindo reprocessá-los sem acesso à rede.
+
+    O conteúdo é endereçado pelo seu SHA-1 (`objects/ab/cdef...`), de forma que
+    versões idênticas de um CV ocupam espaço uma única vez. Para cada id_cnpq, o
+    arquivo `refs/<id_cnpq>` lista as versões baixadas, uma por linha, no formato
+    "<data da obtenção> <sha1>", da mais antiga para a mais recente.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        for subdir in ('objects', 'refs'):
+            mkdirs(os.path.join(path, subdir))
+
+    def put(self, id_cnpq, payload, fetchTime=None):
+        """ Armazena o conteúdo `payload` como a versão mais recente do CV de `id_cnpq` """
+        fetchTime = fetchTime or datetime.datetime.utcnow()
+        digest = hashlib.sha1(payload).hexdigest()
+        objPath = self._objPath(digest)
+        if not os.path.exists(objPath):
+            mkdirs(os.path.dirname(objPath))
+            # Grava em um arquivo temporário e renomeia, para que leitores
+            # concorrentes nunca encontrem um objeto incompleto
+            fd, tmpPath = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(objPath))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.rename(tmpPath, objPath)
+        with self.lock:
+            with open(self._refPath(id_cnpq), 'a') as f:
+                f.write('%s %s\n' % (fetchTime.strftime(TIME_FORMAT), digest))
+        return digest
+
+    def get(self, id_cnpq, fetchTime=None):
+        """
+        Obtém o conteúdo da versão mais recente do CV de `id_cnpq`, ou da versão
+        mais recente obtida até `fetchTime`, caso fornecido. Retorna None caso não
+        exista versão armazenada.
+        """
+        versions = self.versions(id_cnpq)
+        if fetchTime is not None:
+            versions = [(t, digest) for t, digest in versions if t <= fetchTime]
+        if len(versions) == 0:
+            return None
+        with open(self._objPath(versions[-1][1]), 'rb') as f:
+            return f.read()
+
+    def versions(self, id_cnpq):
+        """ Lista de tuplas (dataObtencao, sha1) das versões armazenadas do CV de `id_cnpq` """
+        try:
+            with open(self._refPath(id_cnpq)) as f:
+                return sorted(parseRef(line) for line in f if line.strip() != '')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def idsCNPq(self):
+        """ Lista os id_cnpq que possuem alguma versão armazenada """
+        return sorted(filename for filename in os.listdir(os.path.join(self.path, 'refs'))
+                      if not filename.startswith('.'))
+
+    def size(self):
+        """ Espaço total ocupado pelos objetos armazenados, em bytes """
+        return sum(os.path.getsize(os.path.join(dirpath, filename))
+                   for dirpath, _, filenames in os.walk(os.path.join(self.path, 'objects'))
+                   for filename in filenames if not filename.startswith('.'))
+
+    def evict(self, maxBytes=wsconf.cvCacheMaxBytes):
+        """
+        Remove as versões mais antigas dos CVs até que o espaço ocupado seja de no
+        máximo `maxBytes`. A versão mais recente de cada CV nunca é removida.
+        """
+        total = self.size()
+        if total <= maxBytes:
+            return
+        with self.lock:
+            versionsById = {id_cnpq: self.versions(id_cnpq) for id_cnpq in self.idsCNPq()}
+            refCount = {}
+            for versions in versionsById.itervalues():
+                for _, digest in versions:
+                    refCount[digest] = refCount.get(digest, 0) + 1
+            candidates = sorted((t, id_cnpq, digest)
+                                for id_cnpq, versions in versionsById.iteritems()
+                                for t, digest in versions[:-1])
+            removed = {}
+            for t, id_cnpq, digest in candidates:
+                if total <= maxBytes:
+                    break
+                removed.setdefault(id_cnpq, set()).add((t, digest))
+                refCount[digest] -= 1
+                if refCount[digest] == 0:
+                    objPath = self._objPath(digest)
+                    total -= os.path.getsize(objPath)
+                    os.remove(objPath)
+            for id_cnpq, removedVersions in removed.iteritems():
+                self._writeRef(id_cnpq, [v for v in versionsById[id_cnpq]
+                                         if v not in removedVersions])
+        logger.info('Removidas %d versões antigas de CVs do cache (%d bytes restantes)',
+                    sum(len(v) for v in removed.itervalues()), total)
+
+    def _writeRef(self, id_cnpq, versions):
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp', dir=os.path.join(self.path, 'refs'))
+        with os.fdopen(fd, 'w') as f:
+            for t, digest in versions:
+                f.write('%s %s\n' % (t.strftime(TIME_FORMAT), digest))
+        os.rename(tmpPath, self._refPath(id_cnpq))
+
+    def _objPath(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def _refPath(self, id_cnpq):
+        return os.path.join(self.path, 'refs', id_cnpq)
+
+
+def parseRef(line):
+    t, digest = line.split()
+    return datetime.datetime.strptime(t, TIME_FORMAT), digest
+
+def mkdirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
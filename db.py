@@ -4,10 +4,11 @@ import sqlalchemy
 from sqlalchemy import Column, ForeignKey, UniqueConstraint, CheckConstraint, Index, \
      BigInteger, Integer, String, DateTime, Date, Boolean
 from sqlalchemy.dialects.postgresql import JSONB, ENUM
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy import func
+from sqlalchemy.orm import relationship, backref, column_property
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import func, event, select, DDL
 import sys, datetime
-from alchemyext.view import view
+import metadata, jsondelta
 from dbconn import *
 from ufscar.db import *
 
@@ -47,8 +48,17 @@ class Revision(Base):
     item_id = Column(BigInteger, ForeignKey('synclattes.item.id'), nullable=False, index=True)
     retrieval_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     source = Column(String, nullable=False, index=True)
-    meta = Column(JSONB(none_as_null=True), nullable=True)  # null se o item foi removido
-    duplicate_of_id = Column(BigInteger, ForeignKey('synclattes.revision.id'), nullable=True)
+    # null se o item foi removido. Acessado por meio do atributo `meta`, pois pode
+    # conter apenas a diferença para a revisão `meta_base` (vide compactrevisions)
+    _meta = Column('meta', JSONB(none_as_null=True), nullable=True, key='meta')
+    duplicate_of_id = Column(BigInteger, ForeignKey('synclattes.revision.id'), nullable=True, index=True)
+    # resumo do meta (vide metadata.digest), preenchido automaticamente nas
+    # inserções de uma única linha; null em revisões anteriores à coluna
+    meta_digest = Column(String(40), nullable=True, index=True,
+                         default=lambda ctx: metadata.digest(ctx.current_parameters.get('meta')))
+    # se não for null, a coluna meta contém o patch (vide jsondelta) que, aplicado
+    # ao meta desta revisão, reconstrói o meta da revisão atual
+    meta_base_id = Column(BigInteger, ForeignKey('synclattes.revision.id'), nullable=True)
 
     __tablename__ = 'revision'
     __table_args__ = (Index('ix_synclattes_item_id_rev_id', item_id.asc(), id.desc()),
@@ -57,62 +67,217 @@ class Revision(Base):
     duplicates = relationship('Revision', backref=backref('duplicate_of', remote_side=[id]),
                               foreign_keys=[duplicate_of_id])
 
+    meta_base = relationship('Revision', remote_side=[id], foreign_keys=[meta_base_id])
+
+    @hybrid_property
+    def meta(self):
+        """
+        Metadados da revisão, reconstruídos a partir da revisão base caso esta
+        revisão tenha sido compactada. Em expressões SQL, corresponde à coluna
+        meta, que só contém o metadado completo se meta_base_id for null.
+        """
+        base = self.meta_base
+        if base is None:
+            return self._meta
+        return jsondelta.patch(base.meta, self._meta)
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = value
+        self.meta_base = None
+
+    @meta.expression
+    def meta(cls):
+        return cls._meta
+
+    def compact(self, base, delta):
+        """ Passa a armazenar apenas o patch `delta` em relação à revisão `base` """
+        self._meta = delta
+        self.meta_base = base
+
     def __repr__(self):
         return '<Revision(id=%r, item=%r, retrieval_time=%r, source=%r, meta=%r, duplicate_of_id=%r)>' % \
                (self.id, self.item, self.retrieval_time, self.source, self.meta, self.duplicate_of_id)
 
 
 class LastRevision(Base):
-    __rev = Revision.__table__
-    __table__ = view('last_revision', Base.metadata,
-                     sqlalchemy.select([__rev.c.id,
-                                        __rev.c.item_id,
-                                        __rev.c.retrieval_time,
-                                        __rev.c.source,
-                                        __rev.c.meta,
-                                        __rev.c.duplicate_of_id])\
-                               .distinct(__rev.c.item_id)\
-                               .select_from(__rev)\
-                               .order_by(__rev.c.item_id.asc(), __rev.c.id.desc()),
-                     schema='synclattes',
-                     prefixes=['MATERIALIZED'])
-
-    __indexes__ = [Index('ix_synclattes_last_revision_id',
-                         __table__.c.id),
-                   Index('ix_synclattes_last_revision_item_id',
-                         __table__.c.item_id),
-                   Index('ix_synclattes_last_revision_duplicate_of',
-                         __table__.c.duplicate_of_id),
-                   Index('ix_synclattes_last_revision_uri0',
-                         func.lower(__table__.c.meta[('dc','identifier','uri',0,'value')].astext))]
+    """
+    Última revisão de cada item. É uma tabela mantida pelo próprio banco de
+    dados, por meio de um gatilho em `revision` (vide `lastRevisionTriggerDDL`),
+    e portanto nunca deve ser alterada diretamente.
+    """
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    item_id = Column(BigInteger, ForeignKey('synclattes.item.id'), nullable=False)
+    retrieval_time = Column(DateTime, nullable=False)
+    source = Column(String, nullable=False)
+    meta = Column(JSONB(none_as_null=True), nullable=True)
+    duplicate_of_id = Column(BigInteger, nullable=True)
+    meta_digest = Column(String(40), nullable=True)
+    # campos extraídos do meta pelo gatilho (vide _lastRevDerivedCols)
+    title_norm = Column(String, nullable=True)   # dc.title em minúsculas, sem espaços sobrando
+    doi = Column(String, nullable=True)          # dc.identifier.uri em minúsculas, se for um DOI
+    type = Column(String, nullable=True)         # dc.type
+    date_issued = Column(String, nullable=True)  # dc.date.issued
+
+    __tablename__ = 'last_revision'
+    __table_args__ = (Index('ix_synclattes_last_revision_item_id', item_id, unique=True),
+                      Index('ix_synclattes_last_revision_duplicate_of', duplicate_of_id),
+                      Index('ix_synclattes_last_revision_title_norm', title_norm),
+                      Index('ix_synclattes_last_revision_doi', doi),
+                      Index('ix_synclattes_last_revision_type', type),
+                      Index('ix_synclattes_last_revision_date_issued', date_issued),
+                      {'schema': 'synclattes'})
 
     item = relationship('Item', uselist=False, backref=backref('last_revision', uselist=False),
-                        foreign_keys=[__table__.c.item_id])
+                        foreign_keys=[item_id])
 
     editable = relationship('Revision', uselist=False, backref='last_revision',
-                            foreign_keys=[__table__.c.id],
-                            primaryjoin=__table__.c.id == Revision.id)
+                            foreign_keys=[id],
+                            primaryjoin='LastRevision.id == Revision.id')
 
-    duplicates = relationship('LastRevision', backref=backref('duplicate_of',
-                                                              remote_side=[__table__.c.id]),
-                              foreign_keys=[__table__.c.duplicate_of_id])
+    duplicates = relationship('LastRevision', backref=backref('duplicate_of', remote_side=[id]),
+                              foreign_keys=[duplicate_of_id],
+                              primaryjoin='LastRevision.duplicate_of_id == LastRevision.id')
 
     def __repr__(self):
         return '<LastRevision(id=%r, item=%r, retrieval_time=%r, source=%r, meta=%r, duplicate_of_id=%r)>' % \
                (self.id, self.item, self.retrieval_time, self.source, self.meta, self.duplicate_of_id)
 
+# O gatilho é criado após a tabela revision
+LastRevision.__table__.add_is_dependent_on(Revision.__table__)
+
+# Última revisão do item da revisão principal (vide deduplicate.merge). Por ser
+# uma subconsulta correlacionada, só é carregada quando solicitada via undefer()
+_mainRev = Revision.__table__.alias('main_rev')
+_mainLastRev = LastRevision.__table__.alias('main_last_rev')
+LastRevision.main_last_id = column_property(
+    select([_mainLastRev.c.id])
+    .select_from(_mainRev.join(_mainLastRev, _mainLastRev.c.item_id == _mainRev.c.item_id))
+    .where(_mainRev.c.id == LastRevision.duplicate_of_id)
+    .as_scalar(),
+    deferred=True)
+
+_lastRevCols = 'id, item_id, retrieval_time, source, meta, duplicate_of_id, meta_digest'
+
+# Colunas de last_revision calculadas a partir do meta, e expressões SQL
+# correspondentes (em função de %(meta)s). Correspondem aos métodos getTitle
+# (normalizado), getDoi (em minúsculas), getType e getSingle('dc.date.issued')
+# de JSONMetadataWrapper.
+_lastRevDerivedCols = [
+    ('title_norm', r"""lower(regexp_replace(btrim(%(meta)s #>> '{dc,title,"",0,value}'), '\s+', ' ', 'g'))"""),
+    ('doi', """CASE WHEN left(lower(%(meta)s #>> '{dc,identifier,uri,0,value}'), 21) = 'http://dx.doi.org/10.'
+                   THEN lower(%(meta)s #>> '{dc,identifier,uri,0,value}') END"""),
+    ('type', """%(meta)s #>> '{dc,type,"",0,value}'"""),
+    ('date_issued', """%(meta)s #>> '{dc,date,issued,0,value}'"""),
+]
+
+def _lastRevDerivedExprs(meta):
+    return ', '.join(expr % {'meta': meta} for col, expr in _lastRevDerivedCols)
+
+_lastRevAllCols = _lastRevCols + ', ' + ', '.join(col for col, expr in _lastRevDerivedCols)
+
+# Mantém a tabela last_revision a cada linha inserida, alterada ou removida de
+# revision. O custo é proporcional ao número de linhas modificadas: nas inserções,
+# a linha do item é substituída caso a nova revisão seja mais recente; nas
+# alterações e remoções, a linha do item só é recalculada (pelo índice
+# ix_synclattes_item_id_rev_id) caso a revisão afetada seja a última do item.
+lastRevisionTriggerDDL = DDL("""
+CREATE OR REPLACE FUNCTION synclattes.maintain_last_revision() RETURNS trigger AS $$
+BEGIN
+    -- Os IFs são aninhados pois OLD e NEW nem sempre estão definidos, e o
+    -- plpgsql não garante a avaliação em curto-circuito do AND
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.id = OLD.id AND NEW.item_id = OLD.item_id THEN
+            UPDATE synclattes.last_revision
+               SET retrieval_time = NEW.retrieval_time, source = NEW.source, meta = NEW.meta,
+                   duplicate_of_id = NEW.duplicate_of_id, meta_digest = NEW.meta_digest,
+                   (%(derivedCols)s) = (%(newDerived)s)
+             WHERE id = NEW.id;
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF EXISTS (SELECT 1 FROM synclattes.last_revision WHERE id = OLD.id) THEN
+            DELETE FROM synclattes.last_revision WHERE item_id = OLD.item_id;
+            INSERT INTO synclattes.last_revision (%(allCols)s)
+                SELECT %(cols)s, %(derived)s FROM synclattes.revision
+                 WHERE item_id = OLD.item_id ORDER BY id DESC LIMIT 1;
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO synclattes.last_revision AS lr (%(allCols)s)
+            VALUES (NEW.id, NEW.item_id, NEW.retrieval_time, NEW.source, NEW.meta,
+                    NEW.duplicate_of_id, NEW.meta_digest, %(newDerived)s)
+            ON CONFLICT (item_id) DO UPDATE
+               SET id = EXCLUDED.id, retrieval_time = EXCLUDED.retrieval_time,
+                   source = EXCLUDED.source, meta = EXCLUDED.meta,
+                   duplicate_of_id = EXCLUDED.duplicate_of_id, meta_digest = EXCLUDED.meta_digest,
+                   (%(derivedCols)s) = (%(excludedDerived)s)
+             WHERE lr.id <= EXCLUDED.id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER maintain_last_revision
+    AFTER INSERT OR UPDATE OR DELETE ON synclattes.revision
+    FOR EACH ROW EXECUTE PROCEDURE synclattes.maintain_last_revision();
+""" % {'cols': _lastRevCols,
+       'allCols': _lastRevAllCols,
+       'derivedCols': ', '.join(col for col, expr in _lastRevDerivedCols),
+       'derived': _lastRevDerivedExprs('meta'),
+       'newDerived': _lastRevDerivedExprs('NEW.meta'),
+       'excludedDerived': _lastRevDerivedExprs('EXCLUDED.meta')})
+
+# Preenche a tabela a partir das revisões existentes. Para migrar um banco de
+# dados que ainda possua a antiga MATERIALIZED VIEW, basta removê-la
+# (DROP MATERIALIZED VIEW synclattes.last_revision) e executar este script.
+# Caso a tabela já exista, mas sem alguma das colunas atuais, remova-a com
+# db.LastRevision.__table__.drop(db.getEngine()), que também remove o gatilho,
+# e execute este script.
+lastRevisionPopulateSelect = """
+    SELECT DISTINCT ON (item_id) %(cols)s, %(derived)s FROM synclattes.revision
+     ORDER BY item_id, id DESC
+""" % {'cols': _lastRevCols,
+       'derived': _lastRevDerivedExprs('meta')}
+
+lastRevisionPopulateDDL = DDL("""
+INSERT INTO synclattes.last_revision (%(allCols)s)""" % {'allCols': _lastRevAllCols} +
+                              lastRevisionPopulateSelect)
+
+event.listen(LastRevision.__table__, 'after_create', lastRevisionTriggerDDL)
+event.listen(LastRevision.__table__, 'after_create', lastRevisionPopulateDDL)
+event.listen(LastRevision.__table__, 'before_drop', DDL(
+    'DROP TRIGGER IF EXISTS maintain_last_revision ON synclattes.revision; '
+    'DROP FUNCTION IF EXISTS synclattes.maintain_last_revision()'))
+
 
 class PessoaLattes(Base):
     id_cnpq = Column(String, primary_key=True, autoincrement=False)
     pessoa_id = Column(BigInteger, ForeignKey('core.pessoa.id'), nullable=False)
+    cv_last_update = Column(DateTime, nullable=True)  # data de atualização do último CV processado
 
     __tablename__ = 'pessoa_lattes'
     __table_args__ = (UniqueConstraint(pessoa_id),
                       {'schema': 'synclattes'})
 
     def __repr__(self):
-        return '<PessoaLattes(id_cnpq=%r, pessoa_id=%r)>' % \
-               (self.id_cnpq, self.pessoa_id)
+        return '<PessoaLattes(id_cnpq=%r, pessoa_id=%r, cv_last_update=%r)>' % \
+               (self.id_cnpq, self.pessoa_id, self.cv_last_update)
+
+class PessoaSemLattes(Base):
+    """ Pessoas para as quais a última busca pelo id_cnpq não encontrou um CV Lattes """
+    pessoa_id = Column(BigInteger, ForeignKey('core.pessoa.id'), primary_key=True, autoincrement=False)
+    checked_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __tablename__ = 'pessoa_sem_lattes'
+    __table_args__ = {'schema': 'synclattes'}
+
+    pessoa = relationship('Pessoa', backref=backref('sem_lattes', uselist=False))
+
+    def __repr__(self):
+        return '<PessoaSemLattes(pessoa_id=%r, checked_time=%r)>' % \
+               (self.pessoa_id, self.checked_time)
 
 class RevNormTitle(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=False)
@@ -128,5 +293,5 @@ class RevNormTitle(Base):
 
 if __name__ == '__main__':
     # Se o script for executado diretamente, cria as tabelas
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(getEngine())
 
@@ -1,14 +1,56 @@
 # -*- encoding: utf-8 -*-
+import sys, threading, Queue
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import ClauseElement
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import insert
 from alchemyext.view import RefreshMaterializedView
 import conf.dbconf as dbconf
 
-engine = create_engine(dbconf.url)
+
+class LazyProxy(object):
+    """
+    Encaminha os acessos ao objeto retornado por `factory`, que só é chamada no
+    primeiro acesso. Permite que `engine` e `session` sejam importados sem que
+    nenhuma conexão ou configuração do banco de dados seja necessária.
+    """
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None)
+    def _get(self):
+        obj = object.__getattribute__(self, '_obj')
+        if obj is None:
+            obj = object.__getattribute__(self, '_factory')()
+            object.__setattr__(self, '_obj', obj)
+        return obj
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+    def __contains__(self, x):
+        return x in self._get()
+    def __iter__(self):
+        return iter(self._get())
+    def __repr__(self):
+        return repr(self._get())
+
+_engine = None
+
+def getEngine():
+    """ Engine do banco de dados configurado em conf.dbconf, criada no primeiro uso """
+    global _engine
+    if _engine is None:
+        _engine = create_engine(dbconf.url)
+        if dbconf.sqlStats:
+            import sqlstats
+            sqlstats.install(_engine)
+        Session.configure(bind=_engine)
+    return _engine
+
+engine = LazyProxy(getEngine)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
 
 # http://stackoverflow.com/a/2587041
 def get_or_create(session, model, defaults=None, **kwargs):
@@ -22,25 +64,51 @@ def get_or_create(session, model, defaults=None, **kwargs):
         session.add(instance)
         return instance, True
 
+def insert_ignore(session, model, values, returning=()):
+    """
+    Insere as linhas `values` (lista de dicionários) na tabela de `model`,
+    ignorando as que violariam alguma restrição de unicidade. Ao contrário de
+    `get_or_create`, é seguro mesmo que outros processos insiram as mesmas
+    linhas concorrentemente. Retorna as colunas `returning` das linhas inseridas.
+    """
+    table = model.__table__
+    q = insert(table).values(values).on_conflict_do_nothing()
+    if len(returning) > 0:
+        return session.execute(q.returning(*[table.c[col] for col in returning])).fetchall()
+    session.execute(q)
+    return []
+
 def refresh_materialized_view(session, model):
     """
-    Atualiza os dados de uma MATERIALIZED VIEW.
+    Atualiza os dados de uma MATERIALIZED VIEW. Tabelas mantidas de forma
+    incremental pelo banco de dados (como a LastRevision) dispensam a
+    atualização, e nesse caso apenas a transação atual é commitada.
 
     Importante: A transação atual é commitada antes de realizar a operação.
     """
     session.commit()
-    engine.execute(RefreshMaterializedView(model.__table__))
+    table = model.__table__
+    if table.__visit_name__ == 'view' and 'MATERIALIZED' in table._prefixes:
+        getEngine().execute(RefreshMaterializedView(table))
 
 def create_temp_table(model):
-    model.__table__.create(bind = engine)
+    model.__table__.create(bind = getEngine())
 
-def yield_batches(q, id_field, batch_size=1024, id_from_row=None):
+def yield_batches(q, id_field, batch_size=1024, id_from_row=None, stream=False, prefetch=False):
     """
     Executes a query `q` by batches of `batch_size` over `id_field`.
     If the query does not return an ORM object, provide an `id_from_row`
     function to extract the id field value from the row, e.g.
     `lambda row: row[0]` for extracting the first field from the row.
+
+    If `stream` is true, the query is instead executed only once and its rows
+    are fetched by batches of `batch_size` from a server-side cursor (see
+    `stream_query`, including the `prefetch` option).
     """
+    if stream:
+        for row in stream_query(q, batch_size, prefetch):
+            yield row
+        return
     curId = 0
     if id_from_row is None:
         assert hasattr(id_field, 'key'), \
@@ -56,6 +124,88 @@ def yield_batches(q, id_field, batch_size=1024, id_from_row=None):
             yield row
         curId = id_from_row(batch[-1])
 
-session = Session()
-session.__class__.get_or_create = get_or_create
-session.__class__.refresh_materialized_view = refresh_materialized_view
+def stream_query(q, fetch_size=dbconf.streamFetchSize, prefetch=dbconf.streamPrefetch):
+    """
+    Executes a query `q` only once, on a server-side cursor of a dedicated
+    connection, fetching `fetch_size` rows at a time. The query must select
+    columns, not ORM entities.
+
+    Since the connection is not the one used by `session`, commits done while
+    iterating do not invalidate the cursor. The rows reflect the state of the
+    database at the moment the query was executed.
+
+    If `prefetch` is true, the next `fetch_size` rows are fetched by a background
+    thread while the current ones are being processed.
+    """
+    chunks = _yield_stream_chunks(q.statement, fetch_size)
+    if prefetch:
+        chunks = _prefetch(chunks)
+    for chunk in chunks:
+        for row in chunk:
+            yield row
+
+def _yield_stream_chunks(statement, fetch_size):
+    conn = getEngine().connect()
+    try:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        while True:
+            chunk = result.fetchmany(fetch_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+    finally:
+        conn.close()
+
+def _prefetch(iterable, depth=1):
+    """
+    Consumes `iterable` on a background thread, keeping up to `depth` items
+    ready ahead of the caller. Exceptions are re-raised on the caller's thread.
+    """
+    import sqlstats
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+    # Statements run by the worker are attributed to the caller's stage
+    stage = sqlstats.currentStage()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        sqlstats.setStage(stage)
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except:
+            put((None, sys.exc_info()))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        # Interrupts the thread if the caller stops iterating early
+        stop.set()
+
+Session.get_or_create = get_or_create
+Session.insert_ignore = insert_ignore
+Session.refresh_materialized_view = refresh_materialized_view
+session = LazyProxy(lambda: Session(bind=getEngine()))
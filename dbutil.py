@@ -1,8 +1,13 @@
 # -*- encoding: utf-8 -*-
+import time, logging
+from collections import defaultdict
 from sqlalchemy import select, exists, join, or_
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, joinedload
 from alchemyext.arraysel import ArraySel
-import db
+import conf.dbconf as dbconf
+import db, util
+
+logger = logging.getLogger('dbutil')
 
 
 def yieldNotYetSyncedRevisions(q, **kwargs):
@@ -13,10 +18,12 @@ def yieldNotYetSyncedRevisions(q, **kwargs):
     - `id_from_row`: função para obter o item_id a partir da projeção, caso o
       resultado não esteja sendo coletado em um objeto ORM.
     """
-    return db.yield_batches(q.filter(db.Item.dspace_cur_rev_id
-                                     .op('is distinct from')
-                                     (db.LastRevision.id)),
-                            db.LastRevision.item_id, **kwargs)
+    return db.yield_batches(filterNotYetSynced(q), db.LastRevision.item_id, **kwargs)
+
+
+def filterNotYetSynced(q):
+    """ Filtra a query `q` para as últimas revisões que ainda não foram sincronizadas """
+    return q.filter(db.Item.dspace_cur_rev_id.op('is distinct from')(db.LastRevision.id))
 
 
 def filterLastRevGroup(q, rev):
@@ -27,7 +34,21 @@ def filterLastRevGroup(q, rev):
         db.LastRevision.duplicate_of_id == rev.id))
 
 
-def yieldRevIdGroups(excludeDeletedMeta=True, excludeSingleRevs=True, onlyGroupsPendingSync=True, batch_size=8192):
+def yieldRevIdGroups(excludeDeletedMeta=True, excludeSingleRevs=True, onlyGroupsPendingSync=True,
+                     batch_size=dbconf.streamFetchSize):
+    """
+    Percorre tuplas (id da revisão principal, lista de ids das duplicatas) dos
+    grupos de duplicatas de last_revision.
+
+    A consulta é executada uma única vez, via cursor no servidor, e reflete o
+    estado do banco de dados no início da iteração.
+    """
+    return db.yield_batches(revIdGroupsQuery(excludeDeletedMeta, excludeSingleRevs, onlyGroupsPendingSync),
+                            None, batch_size, stream=True, prefetch=dbconf.streamPrefetch)
+
+
+def revIdGroupsQuery(excludeDeletedMeta=True, excludeSingleRevs=True, onlyGroupsPendingSync=True):
+    """ Query percorrida por yieldRevIdGroups """
     LastRevMain = aliased(db.LastRevision, name='last_rev_main')
     LastRevOther = aliased(db.LastRevision, name='last_rev_other')
 
@@ -54,20 +75,63 @@ def yieldRevIdGroups(excludeDeletedMeta=True, excludeSingleRevs=True, onlyGroups
                           db.func.any(db.func.array_append(q.c.other_revs, q.c.main_id)))
                    .where(db.Item.dspace_cur_rev_id.op('is distinct from')(db.LastRevision.id))))
 
-    return db.yield_batches(outerq, q.c.main_id, batch_size, id_from_row=lambda row:row[0])
+    return outerq.order_by(q.c.main_id)
+
+
+def loadRevGroups(idGroups):
+    """
+    Carrega, em uma única consulta, as revisões de uma lista de tuplas
+    (id da revisão principal, lista de ids das duplicatas), já acompanhadas
+    do item, do pessoa_lattes e da pessoa correspondentes.
+    Retorna a lista de tuplas (revisão principal, lista de duplicatas).
+    """
+    ids = set()
+    for main_id, other_revs in idGroups:
+        ids.add(main_id)
+        ids.update(other_revs)
+    if len(ids) == 0:
+        return []
+    revs = {rev.id: rev for rev in
+            db.session.query(db.Revision)
+                      .options(joinedload(db.Revision.item)
+                               .joinedload(db.Item.pessoa_lattes)
+                               .joinedload(db.PessoaLattes.pessoa))
+                      .filter(db.Revision.id.in_(ids))
+                      .all()}
+    return [(revs[main_id], [revs[rev_id] for rev_id in other_revs])
+            for main_id, other_revs in idGroups]
+
+
+def yieldRevGroups(group_batch_size=512, **kwargs):
+    """
+    Percorre tuplas (revisão principal, lista de duplicatas) dos grupos
+    retornados por `yieldRevIdGroups`, carregando-os por lotes de
+    `group_batch_size` grupos (vide `loadRevGroups`).
+
+    Durante a iteração, os commits não expiram os objetos da sessão, para que
+    os grupos já carregados não voltem a ser consultados um a um.
+    """
+    expire_on_commit = db.session.expire_on_commit
+    db.session.expire_on_commit = False
+    try:
+        for idGroups in util.chunks(yieldRevIdGroups(**kwargs), group_batch_size):
+            for group in loadRevGroups(idGroups):
+                yield group
+    finally:
+        db.session.expire_on_commit = expire_on_commit
 
 
-def yieldRevGroups(**kwargs):
-    for main_id, other_revs in yieldRevIdGroups(**kwargs):
-        yield (db.session.query(db.Revision).filter(db.Revision.id == main_id).one(),
-               [] if len(other_revs) == 0 else
-               db.session.query(db.Revision).filter(db.Revision.id.in_(other_revs)).all())
+# Revisões principais (possíveis alvos de duplicate_of_id) alteradas desde a
+# última chamada a checkTouchedGroupIntegrity
+_touchedRevIds = set()
 
 
 def reassignRevGroup(revisions, mainId):
     # Modifica o campo de todas as revisões, exceto a principal,
     # e de quaisquer revisões que já forem duplicatas das mesmas
     revIds = set(rev.id for rev in revisions) - {mainId,}
+    _touchedRevIds.update(revIds)
+    _touchedRevIds.add(mainId)
     db.session.query(db.Revision) \
         .filter(or_(db.Revision.id.in_(revIds),
                     db.Revision.duplicate_of_id.in_(revIds))) \
@@ -81,9 +145,170 @@ def reassignRevGroup(revisions, mainId):
     db.session.commit()
 
 
+class RevGroupReassigner(object):
+    """
+    Equivalente em lote de reassignRevGroup. As alterações de duplicate_of_id são
+    acumuladas em memória e gravadas com um único UPDATE ... FROM (VALUES ...)
+    por lote (vide `flush`). A transação é efetivada a cada `maxGroups` grupos ou
+    `maxSeconds` segundos, de forma que uma interrupção perde no máximo um lote.
+
+    As alterações pendentes não são visíveis no banco de dados. Ao consultar os
+    grupos de duplicatas, o chamador deve utilizar `duplicateOfId` e
+    `lastRevGroup`, que as consideram, ou chamar `flush` antes.
+    """
+    def __init__(self, maxGroups=dbconf.reassignBatchGroups, maxSeconds=dbconf.reassignBatchSeconds,
+                 expireOnFlush=True):
+        """
+        - `expireOnFlush`: expira os objetos da sessão após gravar as alterações,
+          para que os duplicate_of_id carregados anteriormente sejam recarregados.
+        """
+        self.maxGroups = maxGroups
+        self.maxSeconds = maxSeconds
+        self.expireOnFlush = expireOnFlush
+        self.duplicateOf = {}                    # revisão => nova principal (None se for principal)
+        self.pendingChildren = defaultdict(set)  # inverso de duplicateOf
+        self.redirect = {}                       # principal gravada => atual principal das suas duplicatas
+        self.redirectedFrom = defaultdict(set)   # inverso de redirect
+        self.groups = 0
+        self.lastCommit = time.time()
+
+    def reassign(self, revisions, mainId):
+        """ Equivalente a reassignRevGroup(revisions, mainId), gravado no próximo flush """
+        revIds = set(rev.id for rev in revisions) - {mainId,}
+        for revId in revIds:
+            # As revisões que já eram duplicatas desta, tanto as alteradas neste
+            # lote quanto as já gravadas, passam a apontar para a nova principal
+            for childId in self.pendingChildren.pop(revId, ()):
+                self._setDuplicateOf(childId, mainId)
+            for oldId in self.redirectedFrom.pop(revId, ()):
+                self._setRedirect(oldId, mainId)
+            if revId not in self.redirect:
+                # As duplicatas gravadas ainda apontam para esta revisão
+                self._setRedirect(revId, mainId)
+            self._setDuplicateOf(revId, mainId)
+        self._setDuplicateOf(mainId, None)
+        _touchedRevIds.update(revIds)
+        _touchedRevIds.add(mainId)
+        self.groups += 1
+        if self.groups >= self.maxGroups or time.time() - self.lastCommit >= self.maxSeconds:
+            self.commit()
+
+    def _setDuplicateOf(self, revId, mainId):
+        oldMainId = self.duplicateOf.get(revId)
+        if oldMainId is not None and oldMainId in self.pendingChildren:
+            self.pendingChildren[oldMainId].discard(revId)
+        self.duplicateOf[revId] = mainId
+        if mainId is not None:
+            self.pendingChildren[mainId].add(revId)
+
+    def _setRedirect(self, oldId, mainId):
+        oldMainId = self.redirect.get(oldId)
+        if oldMainId is not None and oldMainId in self.redirectedFrom:
+            self.redirectedFrom[oldMainId].discard(oldId)
+        self.redirect[oldId] = mainId
+        self.redirectedFrom[mainId].add(oldId)
+
+    def pending(self):
+        return len(self.duplicateOf)
+
+    def duplicateOfId(self, rev):
+        """ duplicate_of_id de `rev` (Revision ou LastRevision) considerando as alterações pendentes """
+        return self._duplicateOfId(rev.id, rev.duplicate_of_id)
+
+    def _duplicateOfId(self, revId, storedDuplicateOfId):
+        if revId in self.duplicateOf:
+            return self.duplicateOf[revId]
+        return self.redirect.get(storedDuplicateOfId, storedDuplicateOfId)
+
+    def lastRevGroup(self, rev, *columns):
+        """
+        Equivalente a filterLastRevGroup(db.session.query(*columns), rev).all(),
+        considerando as alterações pendentes
+        """
+        mainId = self.duplicateOfId(rev)
+        if mainId is not None:
+            # Duplicata: o grupo consiste da própria revisão e da sua principal
+            return db.session.query(*columns)\
+                             .filter(db.LastRevision.id.in_({rev.id, mainId})).all()
+        # Principal: duplicatas atribuídas neste lote, e duplicatas já gravadas
+        # de revisões cujas duplicatas foram redirecionadas para `rev`
+        storedMainIds = set(self.redirectedFrom.get(rev.id, ()))
+        if rev.id not in self.redirect:
+            storedMainIds.add(rev.id)
+        conditions = [db.LastRevision.id.in_(self.pendingChildren.get(rev.id, set()) | {rev.id})]
+        if len(storedMainIds) > 0:
+            conditions.append(db.LastRevision.duplicate_of_id.in_(storedMainIds))
+        rows = db.session.query(db.LastRevision.id, db.LastRevision.duplicate_of_id, *columns)\
+                         .filter(or_(*conditions)).all()
+        return [row[2:] for row in rows
+                if row[0] == rev.id or self._duplicateOfId(row[0], row[1]) == rev.id]
+
+    def flush(self):
+        """ Grava as alterações pendentes na transação corrente """
+        if self.pending() == 0:
+            return
+        # Primeiro, as duplicatas já gravadas acompanham a sua antiga principal.
+        # Em seguida, as revisões alteradas explicitamente, que têm precedência.
+        self._updateFromValues('r.duplicate_of_id = v.old_id', self.redirect)
+        self._updateFromValues('r.id = v.old_id', self.duplicateOf)
+        logger.info('Gravadas alterações de %d grupos de duplicatas (%d revisões)',
+                    self.groups, len(self.duplicateOf))
+        self.duplicateOf = {}
+        self.pendingChildren = defaultdict(set)
+        self.redirect = {}
+        self.redirectedFrom = defaultdict(set)
+        if self.expireOnFlush:
+            db.session.expire_all()
+
+    def commit(self):
+        """ Grava as alterações pendentes e efetiva a transação """
+        self.flush()
+        db.session.commit()
+        self.groups = 0
+        self.lastCommit = time.time()
+
+    @staticmethod
+    def _updateFromValues(condition, mapping):
+        if len(mapping) == 0:
+            return
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.execute('UPDATE synclattes.revision AS r SET duplicate_of_id = v.new_id '
+                           'FROM (VALUES ' + ','.join(['(%s::bigint, %s::bigint)'] * len(mapping)) + ') '
+                           'AS v(old_id, new_id) WHERE ' + condition,
+                           [x for pair in mapping.iteritems() for x in pair])
+        finally:
+            cursor.close()
+
+
 def checkGroupIntegrity():
-    """ Verifica se todos os grupos então com duplicate_of_id uniforme """
+    """
+    Verifica se todos os grupos então com duplicate_of_id uniforme.
+    Percorre a tabela inteira; vide checkTouchedGroupIntegrity.
+    """
     return db.session.query(db.func.count())\
                      .filter(db.Revision.id.in_(db.session.query(db.Revision.duplicate_of_id)))\
                      .filter(db.Revision.duplicate_of_id.isnot(None))\
                      .scalar() == 0
+
+
+def checkTouchedGroupIntegrity(chunk_size=8192):
+    """
+    Equivalente a checkGroupIntegrity, mas restrito aos grupos alterados por
+    reassignRevGroup desde a última chamada.
+
+    Toda revisão que passa a ter duplicate_of_id, ou que passa a ser apontada
+    por um duplicate_of_id, está entre as revisões alteradas. Portanto, basta
+    verificar se alguma delas é ao mesmo tempo duplicata e principal.
+    """
+    Duplicate = aliased(db.Revision)
+    for revIds in util.chunks(_touchedRevIds, chunk_size):
+        invalid = db.session.query(db.func.count())\
+                            .filter(db.Revision.id.in_(revIds))\
+                            .filter(db.Revision.duplicate_of_id.isnot(None))\
+                            .filter(exists().where(Duplicate.duplicate_of_id == db.Revision.id))\
+                            .scalar()
+        if invalid > 0:
+            return False
+    _touchedRevIds.clear()
+    return True
@@ -0,0 +1,59 @@
+# -*- encoding: utf-8 -*-
+"""
+Diferenças entre documentos JSON no formato JSON Merge Patch (RFC 7386).
+
+Nesse formato, o patch é um documento com a mesma estrutura de dicionários do
+documento original, contendo apenas as chaves alteradas: o valor null indica
+a remoção da chave, dicionários são aplicados recursivamente e quaisquer
+outros valores (inclusive listas) substituem o valor anterior por inteiro.
+"""
+import copy
+
+
+def diff(src, dst):
+    """
+    Retorna o patch que transforma o dicionário `src` no dicionário `dst`.
+    Levanta ValueError caso algum dicionário de `dst` (fora de listas) contenha
+    valores nulos, que não podem ser representados no formato.
+    """
+    if not isinstance(src, dict) or not isinstance(dst, dict):
+        raise ValueError('Apenas diferenças entre dicionários são suportadas')
+    result = {}
+    for k in src:
+        if k not in dst:
+            result[k] = None
+    for k, v in dst.iteritems():
+        if k in src and src[k] == v:
+            continue
+        if k in src and isinstance(src[k], dict) and isinstance(v, dict):
+            result[k] = diff(src[k], v)
+        else:
+            _checkNoNulls(v)
+            result[k] = copy.deepcopy(v)
+    return result
+
+
+def patch(doc, mergePatch):
+    """ Aplica o patch a `doc`, retornando um novo documento (`doc` não é modificado) """
+    return _patch(copy.deepcopy(doc), mergePatch)
+
+
+def _patch(doc, mergePatch):
+    if not isinstance(mergePatch, dict):
+        return copy.deepcopy(mergePatch)
+    if not isinstance(doc, dict):
+        doc = {}
+    for k, v in mergePatch.iteritems():
+        if v is None:
+            doc.pop(k, None)
+        else:
+            doc[k] = _patch(doc.get(k), v)
+    return doc
+
+
+def _checkNoNulls(value):
+    if value is None:
+        raise ValueError('Valores nulos não podem ser representados em um merge patch')
+    if isinstance(value, dict):
+        for v in value.itervalues():
+            _checkNoNulls(v)
@@ -1,5 +1,5 @@
 # -*- encoding: utf-8 -*-
-import re
+import re, json, hashlib
 from lxml.builder import ElementMaker
 import doiutil, util
 
@@ -32,6 +32,18 @@ class CF:
 # `value`
 # </dim:field>
 #
+
+def digest(meta):
+    """
+    Resumo (SHA-1) da forma canônica de um metadado em JSON, independente da
+    ordem das chaves. Dois metadados são iguais se e somente se os seus resumos
+    forem iguais, o que permite detectar mudanças sem transferir o JSON do banco
+    de dados. Retorna None para metadados nulos.
+    """
+    if meta is None:
+        return None
+    return hashlib.sha1(json.dumps(meta, sort_keys=True, separators=(',', ':'))).hexdigest()
+
 class JSONMetadataBuilder(object):
     def __init__(self):
         self.meta = {}
@@ -86,6 +98,12 @@ class JSONMetadataBuilder(object):
     def build(self):
         return self.meta
 
+def yearFromDateIssued(dateIssued):
+    """ Retorna o ano contido em um dc.date.issued, ou None se este não for um ano """
+    if dateIssued is None or not re.match(r'^\d{4}$', dateIssued):
+        return None
+    return dateIssued
+
 class JSONMetadataWrapper(object):
     def __init__(self, json):
         assert(isinstance(json, dict))
@@ -120,10 +138,7 @@ class JSONMetadataWrapper(object):
         return self.getSingle('dc.type')
 
     def getYear(self):
-        dateIssued = self.getSingle('dc.date.issued')
-        if dateIssued is None or not re.match(r'^\d{4}$', dateIssued):
-            return None
-        return dateIssued
+        return yearFromDateIssued(self.getSingle('dc.date.issued'))
 
     def iterMetadata(self):
         for mdschema, elements in self.json.iteritems():
@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+"""
+Estatísticas de tempo de execução dos comandos SQL, agregadas por comando
+normalizado (sem os valores dos parâmetros) e pela etapa em execução.
+
+Ativadas pela opção `sqlStats` de conf.dbconf (vide dbconn.getEngine). Ao
+final da execução, os comandos que consumiram mais tempo são listados no log e,
+opcionalmente, todas as estatísticas são gravadas em um arquivo JSON.
+"""
+import os, re, sys, json, math, time, atexit, random, datetime, logging, threading
+from contextlib import contextmanager
+from sqlalchemy import event
+import conf.dbconf as dbconf
+
+logger = logging.getLogger('sqlstats')
+
+
+class StatementStats(object):
+    """
+    Estatísticas de um comando SQL normalizado em uma etapa. Os percentis são
+    calculados sobre uma amostra uniforme de até `maxSamples` tempos de execução
+    (reservoir sampling), para que a memória não cresça com a duração da execução.
+    """
+    def __init__(self, maxSamples):
+        self.count = 0
+        self.totalTime = 0.
+        self.maxTime = 0.
+        self.rows = 0
+        self.maxSamples = maxSamples
+        self.times = []
+
+    def add(self, elapsed, rows):
+        self.count += 1
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        self.rows += rows
+        if len(self.times) < self.maxSamples:
+            self.times.append(elapsed)
+        else:
+            i = random.randrange(self.count)
+            if i < self.maxSamples:
+                self.times[i] = elapsed
+
+    def percentile(self, p):
+        """ Percentil `p` (entre 0 e 100) dos tempos de execução, pelo método nearest-rank """
+        times = sorted(self.times)
+        return times[max(0, int(math.ceil(p / 100. * len(times))) - 1)]
+
+    def toDict(self):
+        return {'count': self.count,
+                'total': self.totalTime,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.maxTime,
+                'rows': self.rows}
+
+
+class SQLStats(object):
+    def __init__(self):
+        self.stats = {}  # (etapa, comando normalizado) => StatementStats
+        self.lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.beforeCursorExecute)
+        event.listen(engine, 'after_cursor_execute', self.afterCursorExecute)
+
+    def beforeCursorExecute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sqlstats_start', []).append(time.time())
+
+    def afterCursorExecute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['sqlstats_start'].pop()
+        rows = max(cursor.rowcount, 0)
+        key = (currentStage(), normalize(statement))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StatementStats(dbconf.sqlStatsSamples)
+            stats.add(elapsed, rows)
+
+    def top(self, n):
+        """ Retorna os `n` itens ((etapa, comando), StatementStats) de maior tempo total """
+        with self.lock:
+            items = self.stats.items()
+        return sorted(items, key=lambda (key, stats): stats.totalTime, reverse=True)[:n]
+
+    def report(self, n=None, jsonPath=None):
+        """ Lista os `n` comandos de maior tempo total e grava as estatísticas em `jsonPath` """
+        n = n or dbconf.sqlStatsTop
+        jsonPath = jsonPath or dbconf.sqlStatsJson
+        if len(self.stats) == 0:
+            return
+        totalTime = sum(stats.totalTime for stats in self.stats.itervalues())
+        totalCount = sum(stats.count for stats in self.stats.itervalues())
+        logger.info('Comandos SQL: %d distintos, %d execuções, %.3fs no total. Top %d por tempo total:',
+                    len(self.stats), totalCount, totalTime, n)
+        logger.info('%10s %8s %9s %9s %9s %10s  %-16s %s',
+                    'total(s)', 'execs', 'p50(ms)', 'p99(ms)', 'max(ms)', 'linhas', 'etapa', 'comando')
+        for (stage, statement), stats in self.top(n):
+            logger.info('%10.3f %8d %9.2f %9.2f %9.2f %10d  %-16s %s',
+                        stats.totalTime, stats.count,
+                        1000 * stats.percentile(50), 1000 * stats.percentile(99),
+                        1000 * stats.maxTime, stats.rows, stage, statement[:200])
+        if jsonPath:
+            self.writeJson(datetime.datetime.now().strftime(jsonPath))
+
+    def writeJson(self, path):
+        with self.lock:
+            items = self.stats.items()
+        with open(path, 'w') as f:
+            json.dump({'argv': sys.argv,
+                       'time': datetime.datetime.utcnow().isoformat(),
+                       'statements': [dict(stats.toDict(), stage=stage, statement=statement)
+                                      for (stage, statement), stats in items]},
+                      f, indent=1)
+        logger.info('Estatísticas dos comandos SQL gravadas em %r', path)
+
+
+def normalize(statement):
+    """ Substitui parâmetros e literais do comando SQL por '?', agrupando listas de valores """
+    s = re.sub(r'%\(\w+\)s|%s', '?', statement)
+    s = re.sub(r"'(?:[^']|'')*'", '?', s)
+    s = re.sub(r'\b\d+(?:\.\d+)?\b', '?', s)
+    s = re.sub(r'\?::\w+', '?', s)
+    s = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', s)
+    s = re.sub(r'\(\?(?:, \.\.\.)?\)(?:\s*,\s*\(\?(?:, \.\.\.)?\))+', '(?, ...), ...', s)
+    return re.sub(r'\s+', ' ', s).strip()
+
+
+_instance = None
+# Etapa atual de cada thread, mantida mesmo antes de as estatísticas serem
+# instaladas (o que só ocorre ao criar o engine, vide dbconn.getEngine).
+# Threads que não definirem a etapa utilizam o nome do script
+_defaultStage = os.path.basename(sys.argv[0]) or 'python'
+_local = threading.local()
+
+def install(engine):
+    """ Passa a coletar as estatísticas dos comandos executados em `engine` """
+    global _instance
+    if _instance is None:
+        _instance = SQLStats()
+        atexit.register(_instance.report)
+    _instance.install(engine)
+    return _instance
+
+def currentStage():
+    """ Etapa atribuída aos comandos executados pela thread atual """
+    return getattr(_local, 'stage', _defaultStage)
+
+def setStage(name):
+    """ Define a etapa atribuída aos próximos comandos da thread atual """
+    _local.stage = name
+
+@contextmanager
+def stage(name):
+    """ Atribui os comandos executados pela thread atual dentro do bloco à etapa `name` """
+    previous = currentStage()
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
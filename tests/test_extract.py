@@ -0,0 +1,86 @@
+# -*- encoding: utf-8 -*-
+"""
+Testes do extract que não dependem do banco de dados nem do web service.
+
+Executar a partir da raiz do repositório:
+    python -m unittest discover tests
+"""
+import imp, unittest
+from bench.lattesgen import LattesGenerator, compress
+
+extract = imp.load_source('extract', 'extract')
+
+
+class FakePessoaLattes(object):
+    def __init__(self, id_cnpq):
+        self.id_cnpq = id_cnpq
+        self.cv_last_update = None
+
+    def __repr__(self):
+        return '<FakePessoaLattes(id_cnpq=%r)>' % self.id_cnpq
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class RecordingCVProcessor(object):
+    """ Substitui o CVProcessor, apenas consumindo as produções do CV """
+    processed = []
+
+    def __init__(self, pessoaLattes, producoes):
+        self.pessoaLattes = pessoaLattes
+        self.producoes = producoes
+
+    def run(self):
+        producoes = list(self.producoes)
+        RecordingCVProcessor.processed.append((self.pessoaLattes.id_cnpq, len(producoes)))
+
+
+class ParseCVsTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = extract.CVProcessor, extract.db.session, extract.bulkWriter, extract.dryRun
+        extract.CVProcessor = RecordingCVProcessor
+        extract.db.session = self.session = FakeSession()
+        extract.bulkWriter = None
+        extract.dryRun = False
+        RecordingCVProcessor.processed = []
+        self.gen = LattesGenerator(seed=1)
+
+    def tearDown(self):
+        extract.CVProcessor, extract.db.session, extract.bulkWriter, extract.dryRun = self.saved
+
+    def payload(self, id_cnpq):
+        return compress(self.gen.cv(id_cnpq, 2, 2))
+
+    def processAll(self, cvs):
+        for pessoaLattes, lastUpdate, producoes in extract.parseCVs(cvs):
+            extract.processCV(pessoaLattes, producoes, lastUpdate)
+
+    def test_truncatedPayloadDoesNotAbortTheRun(self):
+        good = self.payload('1000000000000002')
+        cvs = [(FakePessoaLattes('1000000000000001'), 'd1', good[:len(good) // 2]),
+               (FakePessoaLattes('1000000000000002'), 'd2', good)]
+        self.processAll(cvs)
+        self.assertEqual(RecordingCVProcessor.processed, [('1000000000000002', 4)])
+        self.assertEqual(cvs[0][0].cv_last_update, None)
+        self.assertEqual(cvs[1][0].cv_last_update, 'd2')
+
+    def test_missingDadosGeraisDoesNotAbortTheRun(self):
+        cvs = [(FakePessoaLattes('1000000000000001'), 'd1', compress('<CURRICULO-VITAE/>')),
+               (FakePessoaLattes('1000000000000002'), 'd2', self.payload('1000000000000002'))]
+        self.processAll(cvs)
+        self.assertEqual(RecordingCVProcessor.processed, [('1000000000000002', 4)])
+        self.assertEqual(cvs[0][0].cv_last_update, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
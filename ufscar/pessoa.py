@@ -1,7 +1,9 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
 from sqlalchemy import or_, and_
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
+from collections import defaultdict
 import db, util
 
 class PessoaInstituicao(object):
@@ -16,6 +18,38 @@ class PessoaInstituicao(object):
                    )).one())
         except NoResultFound:
             return None
+    @staticmethod
+    def fromIdentificadores(cpfsOrNumerosUFSCar):
+        """
+        Equivalente a `fromIdentificador` para vários identificadores, resolvidos
+        em uma única consulta que já carrega o `pessoa_lattes` e o `sem_lattes`
+        de cada pessoa.
+        Retorna um dicionário identificador => PessoaInstituicao, do qual são
+        omitidos os identificadores não encontrados.
+        """
+        idents = set(cpfsOrNumerosUFSCar)
+        if len(idents) == 0:
+            return {}
+        # Número UFSCar => identificadores fornecidos (que podem conter zeros à esquerda)
+        numeros = defaultdict(list)
+        for ident in idents:
+            if ident.isdigit():
+                numeros[int(ident)].append(ident)
+        pessoas = db.session.query(db.Pessoa)\
+                            .options(joinedload(db.Pessoa.pessoa_lattes),
+                                     joinedload(db.Pessoa.sem_lattes))\
+                            .filter(or_(db.Pessoa.cpf.in_(idents),
+                                        db.Pessoa.id.in_(numeros.keys())))\
+                            .all()
+        result = {}
+        for pessoa in pessoas:
+            for ident in numeros.get(pessoa.id, ()):
+                result.setdefault(ident, PessoaInstituicao(pessoa))
+        # Em caso de conflito, a correspondência pelo CPF tem precedência
+        for pessoa in pessoas:
+            if pessoa.cpf in idents:
+                result[pessoa.cpf] = PessoaInstituicao(pessoa)
+        return result
     def getEntidade(self):
         """ Entidade a ser inserida na chave estrangeira de PessoaLattes """
         return self.entidade
@@ -27,6 +61,9 @@ class PessoaInstituicao(object):
         return self.entidade.data_nascimento.strftime('%d/%m/%Y')
     def getPessoaLattes(self):
         return self.entidade.pessoa_lattes
+    def getSemLattes(self):
+        """ Registro da última busca sem sucesso pelo CV Lattes da pessoa, ou None """
+        return self.entidade.sem_lattes
     def getRoles(self):
         """ Retorna lista de vínculos ativos da pessoa com a universidade """
         return map(util.firstOrNone,
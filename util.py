@@ -1,5 +1,6 @@
 # -*- encoding: utf-8 -*-
 import re, unicodedata
+from collections import OrderedDict
 import lxml.html
 import conf.wsconf as wsconf
 
@@ -31,12 +32,55 @@ def norm(s, level=NormLevel.REMOVE_ACCENTS, encoding=wsconf.serverEncoding):
     return re.sub(r'\s+', ' ', s)
 
 
+class LRUCache(object):
+    """ Cache de tamanho limitado que descarta os valores usados há mais tempo """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def get(self, key, compute):
+        """ Obtém o valor de `key`, calculando-o com `compute(key)` caso não esteja no cache """
+        try:
+            value = self.data.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute(key)
+            self.misses += 1
+            if len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+        self.data[key] = value
+        return value
+    def __len__(self):
+        return len(self.data)
+    def __repr__(self):
+        return '<LRUCache(maxsize=%r, size=%r, hits=%r, misses=%r)>' % \
+               (self.maxsize, len(self.data), self.hits, self.misses)
+
+# Valores decodificados pelo lxml (nomes de periódicos e de autores se repetem bastante)
+htmlCache = LRUCache(maxsize=16384)
+
+# Caracteres cuja presença exige a decodificação pelo lxml: início de tags e de
+# entities, além de caracteres de controle, que são descartados pelo lxml
+htmlSlowPathRegex = re.compile(u'[<&\x00-\x08\x0b\x0c\x0e-\x1f]')
+
 def decodeHtml(s, encoding=wsconf.serverEncoding):
     """ Decodifica a string como HTML de forma permissiva """
     if s is None:
         return None
     if not isinstance(s, unicode):
         s = s.decode(encoding)
+    if htmlSlowPathRegex.search(s) is None:
+        # Otimização: texto sem marcação, para o qual basta reproduzir a remoção
+        # de espaços iniciais realizada pelo lxml (exceto se restarem apenas espaços,
+        # situação na qual o lxml falha e a string é retornada intacta)
+        stripped = s.lstrip(u' \t\n\r')
+        if stripped == u'':
+            return s
+        return stripped.replace(u'\xa0', u' ')  # converte '&nbsp;' para espaço comum
+    return htmlCache.get(s, _decodeHtmlWithLxml)
+
+def _decodeHtmlWithLxml(s):
     try:
         return lxml.html.document_fromstring(s).text_content()\
                .replace(u'\xa0', u' ')  # converte '&nbsp;' para espaço comum
@@ -102,6 +146,17 @@ def uniq(seq):
     seen_add = seen.add
     return [x for x in seq if not (x in seen or seen_add(x))]
 
+def chunks(iterable, size):
+    """ Percorre listas de até `size` elementos consecutivos de `iterable` """
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
 def maybeBind(f, value):
     """ Operador de bind no monad Maybe, onde Nothing é representado por None """
     if value is None:
@@ -1,50 +1,171 @@
 # -*- encoding: utf-8 -*-
-import time, traceback, base64, io, zipfile
-import suds, suds.client
+import datetime, base64, io, zipfile, httplib
+import suds, suds.client, suds.cache, suds.transport
+import urllib3, certifi
 from lxml import etree
 import conf.wsconf as wsconf
-import util
-
-
-class Retry(object):
-    def __init__(decorator, times=3, sleeptime=2.0):
-        decorator.times = times
-        decorator.sleeptime = sleeptime
-    def __call__(decorator, func):
-        def newFunc(*args, **kwargs):
-            for i in xrange(decorator.times):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    lasterr = e
-                    traceback.print_exc(e)
-                    time.sleep(decorator.sleeptime)
-            raise lasterr
-        return newFunc
-
-
-class WSCurriculo(suds.client.Client):
-    def __init__(self):
-        suds.client.Client.__init__(self, wsconf.WSCurriculoUrl)
+import util, wspolicy
+
+
+def parseCV(payload):
+    """ Interpreta o conteúdo compactado (zip) do XML do CV """
+    xmlz = zipfile.ZipFile(io.BytesIO(payload))
+    xml = xmlz.read(xmlz.namelist()[0])
+    return util.HtmlValuesElementWrapper(etree.fromstring(xml))
+
+def iterparseCV(payload, tags):
+    """
+    Percorre incrementalmente o conteúdo compactado (zip) do XML do CV, sem
+    descompactá-lo por inteiro, gerando apenas os elementos cujas tags estejam
+    em `tags`. Cada elemento gerado é descartado assim que o consumidor avança
+    para o próximo, de forma que o consumo de memória independe do tamanho do CV.
+    """
+    xmlz = zipfile.ZipFile(io.BytesIO(payload))
+    stream = xmlz.open(xmlz.namelist()[0])
+    depth = 0  # número de elementos de interesse abertos
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        if elem.tag in tags:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                yield util.HtmlValuesElementWrapper(elem)
+        elif event == 'start' or depth > 0:
+            # Elementos internos a um elemento de interesse são preservados
+            continue
+        # Descarta o elemento e seus irmãos anteriores, já percorridos
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class WSCurriculoMethods(object):
+    """
+    Operações do web service de currículos, comuns aos dois clientes. As
+    subclasses implementam `_call(operacao, **params)`.
+    """
+    def call(self, operacao, **params):
+        """ Chama `operacao` segundo a sua política (vide conf.wsconf.wsPolicies) """
+        return policyEngine.execute(operacao, self._call, operacao, **params)
 
-    @Retry()
     def obterCV(self, idCNPq):
-        b64 = self.service.getCurriculoCompactado(id=idCNPq)
+        return util.maybeBind(parseCV, self.obterCVCompactado(idCNPq))
+
+    def obterCVCompactado(self, idCNPq):
+        """ Conteúdo compactado (zip) do XML do CV, ou None se o CV não existir """
+        b64 = self.call('getCurriculoCompactado', id=idCNPq)
         if b64 is None:
             return None
-        xmlz = zipfile.ZipFile(io.BytesIO(base64.b64decode(b64)))
-        xml = xmlz.read(xmlz.namelist()[0])
-        return util.HtmlValuesElementWrapper(etree.fromstring(xml))
+        return base64.b64decode(b64)
 
-    @Retry()
     def obterIdCNPq(self, *args):
         """ obterIdCNPq(cpf) ou obterIdCNPq(nomeCompleto, dataNascimento) """
         if len(args) == 1:
-            return self.service.getIdentificadorCNPq(cpf=args[0],nomeCompleto='',dataNascimento='')
+            return self.call('getIdentificadorCNPq', cpf=args[0], nomeCompleto='', dataNascimento='')
         elif len(args) == 2:
-            return self.service.getIdentificadorCNPq(cpf='',nomeCompleto=args[0],dataNascimento=args[1])
+            return self.call('getIdentificadorCNPq', cpf='', nomeCompleto=args[0], dataNascimento=args[1])
         raise ValueError('obterIdCNPq deve receber 1 ou 2 parâmetros (cpf ou nomeCompleto e dataNascimento)')
 
-    @Retry()
     def obterOcorrencia(self, idCNPq):
-        return self.service.getOcorrenciaCV(id=idCNPq)
+        return self.call('getOcorrenciaCV', id=idCNPq)
+
+    def obterDataAtualizacao(self, idCNPq):
+        """ Data e hora da última atualização do CV, ou None se o CV não existir """
+        s = self.call('getDataAtualizacaoCV', id=idCNPq)
+        if s is None:
+            return None
+        return datetime.datetime.strptime(s, '%d/%m/%Y %H:%M:%S')
+
+
+class WSCurriculo(suds.client.Client, WSCurriculoMethods):
+    """ Cliente baseado no suds. Cada thread deve utilizar a sua própria instância. """
+    threadSafe = False
+
+    def __init__(self):
+        # O WSDL é armazenado em disco, para que não seja baixado a cada execução
+        cache = suds.cache.ObjectCache(wsconf.wsdlCacheDir, days=wsconf.wsdlCacheDays)
+        suds.client.Client.__init__(self, wsconf.WSCurriculoUrl, cache=cache)
+
+    def _call(self, operacao, **params):
+        return getattr(self.service, operacao)(**params)
+
+
+class SOAPFault(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status  # status HTTP, caso a resposta não seja um envelope SOAP
+
+def isUnavailabilityError(e):
+    """
+    Verifica se a exceção indica que o web service está indisponível (erros de
+    conexão, timeouts, erros de gateway), e não um erro na chamada em si
+    """
+    if isinstance(e, (EnvironmentError, httplib.HTTPException, urllib3.exceptions.HTTPError)):
+        return True
+    status = None
+    if isinstance(e, SOAPFault):
+        status = e.status
+    elif isinstance(e, suds.transport.TransportError):
+        status = e.httpcode
+    return status is not None and (status == 429 or status >= 500)
+
+# Compartilhado por todos os clientes, inclusive os de threads distintas
+policyEngine = wspolicy.PolicyEngine.fromConf(wsconf, isUnavailable=isUnavailabilityError)
+
+class RawWSCurriculo(WSCurriculoMethods):
+    """
+    Cliente que monta os envelopes SOAP diretamente, sem obter nem interpretar
+    o WSDL. Pode ser compartilhado entre threads: as conexões HTTP são mantidas
+    abertas em um pool de até `maxConnections` conexões, que limita também o
+    número de requisições simultâneas (as demais aguardam uma conexão livre).
+    """
+    threadSafe = True
+
+    def __init__(self, url=None, maxConnections=wsconf.wsMaxConnections, timeout=wsconf.wsTimeout):
+        self.url = url or wsconf.WSCurriculoUrl.split('?')[0]
+        self.http = urllib3.PoolManager(
+            num_pools=1,
+            maxsize=maxConnections,
+            block=True,
+            timeout=timeout,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where(),
+            headers={'Content-Type': 'text/xml; charset=utf-8', 'SOAPAction': '""'}
+        )
+
+    def _call(self, operacao, **params):
+        r = self.http.request('POST', self.url, body=buildSOAPRequest(operacao, params))
+        return parseSOAPResponse(r.data, r.status)
+
+
+SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+XSI = 'http://www.w3.org/2001/XMLSchema-instance'
+
+def buildSOAPRequest(operacao, params):
+    """ Envelope SOAP (document/literal wrapped) da chamada a `operacao` """
+    envelope = etree.Element('{%s}Envelope' % SOAP_ENV, nsmap={'soapenv': SOAP_ENV})
+    body = etree.SubElement(envelope, '{%s}Body' % SOAP_ENV)
+    op = etree.SubElement(body, '{%s}%s' % (wsconf.wsNamespace, operacao),
+                          nsmap={'ws': wsconf.wsNamespace})
+    for name, value in sorted(params.iteritems()):
+        etree.SubElement(op, name).text = value
+    return etree.tostring(envelope, xml_declaration=True, encoding='utf-8')
+
+def parseSOAPResponse(data, status=200):
+    """ Valor retornado em uma resposta SOAP, ou None caso seja nulo """
+    if status not in (200, 500):  # erros SOAP são reportados com o status 500
+        raise SOAPFault('HTTP %d' % status, status)
+    envelope = etree.fromstring(data)
+    fault = envelope.find('{%s}Body/{%s}Fault' % (SOAP_ENV, SOAP_ENV))
+    if fault is not None:
+        raise SOAPFault(fault.findtext('faultstring'))
+    ret = envelope.find('{%s}Body/*/return' % SOAP_ENV)
+    if ret is None or ret.get('{%s}nil' % XSI) == 'true':
+        return None
+    return ret.text or u''
+
+
+def wsCurriculoClass():
+    """ Classe do cliente configurada em `conf.wsconf.wsClient` """
+    return RawWSCurriculo if wsconf.wsClient == 'raw' else WSCurriculo
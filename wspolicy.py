@@ -0,0 +1,219 @@
+# -*- encoding: utf-8 -*-
+"""
+Políticas de chamada ao web service: novas tentativas com espera exponencial
+aleatorizada, limite de taxa de requisições e disjuntor (circuit breaker)
+compartilhado por todas as threads.
+"""
+import sys, time, random, threading, logging
+
+logger = logging.getLogger('wspolicy')
+
+
+class Policy(object):
+    """
+    Política de novas tentativas de uma operação. A espera antes da tentativa
+    `n` (a partir de 1) é sorteada entre 0 e min(maxDelay, baseDelay * 2**(n-1)),
+    para que clientes concorrentes não repitam as requisições em sincronia.
+    """
+    def __init__(self, retries=3, baseDelay=1.0, maxDelay=30.0):
+        self.retries = retries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+    def __repr__(self):
+        return '<Policy(retries=%r, baseDelay=%r, maxDelay=%r)>' % \
+               (self.retries, self.baseDelay, self.maxDelay)
+
+
+class TokenBucket(object):
+    """ Limita as requisições a `rate` por segundo, admitindo rajadas de até `burst` """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Aguarda até que uma requisição possa ser feita """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """
+    Após `threshold` falhas consecutivas (apenas erros que indiquem a
+    indisponibilidade do serviço, vide PolicyEngine), considera-o indisponível e
+    suspende todas as chamadas por `resetTime` segundos. Em seguida, uma única
+    chamada de teste é liberada: caso tenha sucesso, as demais são retomadas;
+    caso contrário, o serviço continua indisponível por mais `resetTime` segundos.
+    O mesmo ocorre caso o resultado da chamada de teste não seja informado em
+    `resetTime` segundos.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold, resetTime):
+        self.threshold = threshold
+        self.resetTime = resetTime
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.probeStartedAt = None
+        self.cond = threading.Condition()
+
+    def before(self):
+        """ Aguarda até que uma chamada possa ser feita """
+        with self.cond:
+            while True:
+                if self.state == CircuitBreaker.CLOSED:
+                    return
+                if self.state == CircuitBreaker.OPEN:
+                    remaining = self.openedAt + self.resetTime - time.time()
+                    if remaining <= 0:
+                        self.state = CircuitBreaker.HALF_OPEN
+                        self.probeStartedAt = time.time()
+                        return  # esta é a chamada de teste
+                    self.cond.wait(remaining)
+                else:
+                    # Aguarda o resultado da chamada de teste
+                    remaining = self.probeStartedAt + self.resetTime - time.time()
+                    if remaining <= 0:
+                        logger.error('Chamada de teste sem resultado após %.0fs, '
+                                     'suspendendo as chamadas novamente', self.resetTime)
+                        self.state = CircuitBreaker.OPEN
+                        self.openedAt = time.time()
+                        continue
+                    self.cond.wait(remaining)
+
+    def success(self):
+        with self.cond:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info('Web service disponível novamente, retomando as chamadas')
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.cond.notify_all()
+
+    def failure(self):
+        with self.cond:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or \
+               (self.state == CircuitBreaker.CLOSED and self.failures >= self.threshold):
+                logger.error('Web service indisponível após %d falhas consecutivas, '
+                             'suspendendo as chamadas por %.0fs', self.failures, self.resetTime)
+                self.state = CircuitBreaker.OPEN
+                self.openedAt = time.time()
+                self.cond.notify_all()
+
+
+class CallStats(object):
+    """ Contadores de chamadas de uma operação """
+    def __init__(self):
+        self.calls = 0      # chamadas (incluindo novas tentativas)
+        self.retries = 0    # novas tentativas
+        self.failures = 0   # chamadas que falharam após esgotar as tentativas
+        self.totalTime = 0.
+        self.maxTime = 0.
+        self.lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self.lock:
+            self.calls += 1
+            self.totalTime += elapsed
+            self.maxTime = max(self.maxTime, elapsed)
+
+    def __repr__(self):
+        return '<CallStats(calls=%d, retries=%d, failures=%d, avgTime=%.3fs, maxTime=%.3fs)>' % \
+               (self.calls, self.retries, self.failures,
+                self.totalTime / self.calls if self.calls else 0., self.maxTime)
+
+
+class PolicyEngine(object):
+    """
+    Executa as chamadas ao web service segundo as políticas de cada operação,
+    compartilhando entre todas elas o limite de taxa e o disjuntor
+    """
+    def __init__(self, policies, rateLimit=None, burst=1, breakerThreshold=10, breakerResetTime=60.0,
+                 isUnavailable=lambda e: isinstance(e, EnvironmentError)):
+        """
+        - `policies`: dicionário operação => Policy. A chave 'default' define a
+          política das operações não listadas.
+        - `rateLimit`: máximo de requisições por segundo, ou None para ilimitado.
+        - `isUnavailable`: função que verifica se a exceção indica que o serviço
+          está indisponível (erros de conexão, timeouts). Apenas essas falhas são
+          contadas pelo disjuntor: os demais erros (como falhas SOAP causadas por
+          um identificador inválido) mostram que o serviço está respondendo.
+        """
+        self.policies = policies
+        self.isUnavailable = isUnavailable
+        self.bucket = TokenBucket(rateLimit, burst) if rateLimit else None
+        self.breaker = CircuitBreaker(breakerThreshold, breakerResetTime)
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fromConf(conf, **kwargs):
+        """ Instancia a partir das configurações de `conf.wsconf` """
+        return PolicyEngine({op: Policy(**params) for op, params in conf.wsPolicies.iteritems()},
+                            rateLimit=conf.wsRateLimit,
+                            burst=conf.wsRateBurst,
+                            breakerThreshold=conf.wsBreakerThreshold,
+                            breakerResetTime=conf.wsBreakerResetTime,
+                            **kwargs)
+
+    def policy(self, operation):
+        return self.policies.get(operation) or self.policies['default']
+
+    def getStats(self, operation):
+        with self.lock:
+            return self.stats.setdefault(operation, CallStats())
+
+    def execute(self, operation, func, *args, **kwargs):
+        """ Chama `func(*args, **kwargs)` segundo a política de `operation` """
+        policy = self.policy(operation)
+        stats = self.getStats(operation)
+        attempt = 0
+        while True:
+            self.breaker.before()
+            if self.bucket is not None:
+                self.bucket.acquire()
+            start = time.time()
+            excInfo = None
+            responded = False  # o serviço respondeu, com sucesso ou com um erro da chamada
+            try:
+                result = func(*args, **kwargs)
+                responded = True
+            except Exception as e:
+                excInfo = sys.exc_info()
+                responded = not self.isUnavailable(e)
+            finally:
+                # Executado em qualquer saída (inclusive BaseException), para que o
+                # disjuntor nunca permaneça aguardando o resultado da chamada de teste
+                stats.add(time.time() - start)
+                if responded:
+                    self.breaker.success()
+                else:
+                    self.breaker.failure()
+            if excInfo is None:
+                return result
+            attempt += 1
+            if attempt > policy.retries:
+                with stats.lock:
+                    stats.failures += 1
+                raise excInfo[0], excInfo[1], excInfo[2]
+            delay = policy.delay(attempt)
+            logger.warning('Falha em %s (tentativa %d de %d), repetindo em %.1fs: %r',
+                           operation, attempt, policy.retries + 1, delay, excInfo[1])
+            with stats.lock:
+                stats.retries += 1
+            time.sleep(delay)